@@ -0,0 +1,84 @@
+import json
+import math
+import resource
+from collections import defaultdict
+
+
+def percentile(values, pct):
+    """ nearest-rank percentile of a non-empty list """
+    values = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+
+def peak_rss_mb():
+    """ peak resident set size of this process & of its children (e.g. pdftotext), in MB """
+    # ru_maxrss is reported in kilobytes on linux
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def summarize(samples):
+    """ throughput & latency for a list of (n_bytes, seconds, ok) samples """
+    seconds = [s for _, s, _ in samples]
+    total_seconds = sum(seconds) or 1e-9
+    n_bytes = sum(b for b, _, _ in samples)
+    return {
+        "docs": len(samples),
+        "errors": sum(1 for _, _, ok in samples if not ok),
+        "docs_per_s": len(samples) / total_seconds,
+        "mb_per_s": n_bytes / 1024 / 1024 / total_seconds,
+        "p50_ms": percentile(seconds, 50) * 1000,
+        "p95_ms": percentile(seconds, 95) * 1000,
+        "p99_ms": percentile(seconds, 99) * 1000,
+    }
+
+
+class Benchmark:
+    """ collects per-document timings, grouped by state and by extractor """
+
+    def __init__(self):
+        self.by_state = defaultdict(list)
+        self.by_extractor = defaultdict(list)
+
+    def add(self, state, extractor, n_bytes, seconds, ok):
+        self.by_state[state].append((n_bytes, seconds, ok))
+        self.by_extractor[extractor].append((n_bytes, seconds, ok))
+
+    def results(self):
+        return {
+            "states": {k: summarize(v) for k, v in sorted(self.by_state.items())},
+            "extractors": {k: summarize(v) for k, v in sorted(self.by_extractor.items())},
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def load_baseline(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_baseline(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def regressions(results, baseline, threshold):
+    """ descriptions of every group whose p50 latency or docs/s is worse by more than threshold """
+    found = []
+    for section in ("states", "extractors"):
+        for name, current in results[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous:
+                continue
+            if current["p50_ms"] > previous["p50_ms"] * (1 + threshold):
+                found.append(
+                    f"{name}: p50 {previous['p50_ms']:.1f}ms -> {current['p50_ms']:.1f}ms"
+                )
+            if current["docs_per_s"] < previous["docs_per_s"] * (1 - threshold):
+                found.append(
+                    f"{name}: {previous['docs_per_s']:.1f} -> {current['docs_per_s']:.1f} docs/s"
+                )
+    return found
@@ -0,0 +1,255 @@
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from extract.document import Document
+
+# cache location & size can be overridden from the environment (e.g. in docker-compose)
+CACHE_DIR = os.environ.get("TEXT_EXTRACT_CACHE_DIR", "cache")
+DOCUMENT_CACHE_MB = int(os.environ.get("TEXT_EXTRACT_DOCUMENT_CACHE_MB", 4096))
+RESULT_CACHE_MB = int(os.environ.get("TEXT_EXTRACT_RESULT_CACHE_MB", 1024))
+# bytes read from the network at a time when streaming a download to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def stream_to_file(path, chunks):
+    """
+    write chunks to path while hashing them, returns the sha256 hex digest & size,
+    a partially written file is removed if the stream fails
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                sha.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return sha.hexdigest(), size
+
+
+def temporary_name(path):
+    """ a name next to path that's unique to this process & thread, for write & rename """
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+class SqliteIndex:
+    """
+    lazily opened sqlite index, with a connection per thread that's reopened after a fork
+    so download threads & worker processes can share it
+    """
+
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        local = self._local
+        if getattr(local, "db", None) is None or local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            local.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            local.pid = os.getpid()
+            for statement in self.SCHEMA:
+                local.db.execute(statement)
+        return local.db
+
+
+class DocumentCache(SqliteIndex):
+    """
+    On-disk, content-addressed cache of fetched documents keyed by URL.
+
+    Bodies are stored once per sha256 digest, ETag/Last-Modified are kept per URL so
+    later fetches can be conditional, and the least recently used bodies are evicted
+    once the cache grows past max_mb.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS documents "
+        "(url TEXT PRIMARY KEY, digest TEXT, etag TEXT, last_modified TEXT)",
+        "CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER, used REAL)",
+        "CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used)",
+    )
+
+    def __init__(self, root=CACHE_DIR, max_mb=DOCUMENT_CACHE_MB):
+        self.root = os.path.join(root, "documents")
+        self.max_size = max_mb * 1024 * 1024
+        super().__init__(os.path.join(self.root, "index.sqlite"))
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _lookup(self, url):
+        row = self.db.execute(
+            "SELECT digest, etag, last_modified FROM documents WHERE url = ?", (url,)
+        ).fetchone()
+        if row and os.path.exists(self.blob_path(row[0])):
+            return row
+        return None
+
+    def _touch(self, digest):
+        self.db.execute("UPDATE blobs SET used = ? WHERE digest = ?", (time.time(), digest))
+
+    def fetch(self, scraper, url):
+        """ GET url through scraper, revalidating any cached copy instead of refetching it """
+        cached = self._lookup(url)
+        headers = {}
+        if cached:
+            digest, etag, last_modified = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        with scraper.get(url, headers=headers, stream=True) as resp:
+            if cached and resp.status_code == 304:
+                self._touch(digest)
+                return Document(path=self.blob_path(digest), digest=digest)
+            digest = self.store(
+                url,
+                resp.iter_content(DOWNLOAD_CHUNK_SIZE),
+                resp.headers.get("ETag"),
+                resp.headers.get("Last-Modified"),
+            )
+        return Document(path=self.blob_path(digest), digest=digest)
+
+    def store(self, url, chunks, etag=None, last_modified=None):
+        """ stream a body (an iterable of bytes) into the cache, returns its digest """
+        # the digest is only known at the end, rename so readers never see a partial body
+        tmp_path = temporary_name(os.path.join(self.root, "incoming"))
+        digest, size = stream_to_file(tmp_path, chunks)
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        self.db.execute(
+            "INSERT OR REPLACE INTO blobs (digest, size, used) VALUES (?, ?, ?)",
+            (digest, size, time.time()),
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO documents (url, digest, etag, last_modified) "
+            "VALUES (?, ?, ?, ?)",
+            (url, digest, etag, last_modified),
+        )
+        self.evict()
+        return digest
+
+    def evict(self):
+        """ drop least recently used bodies until the cache fits in max_size """
+        (total,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        if total <= self.max_size:
+            return
+        rows = self.db.execute("SELECT digest, size FROM blobs ORDER BY used").fetchall()
+        for digest, size in rows:
+            if total <= self.max_size:
+                break
+            self.db.execute("DELETE FROM documents WHERE digest = ?", (digest,))
+            self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError:
+                pass
+            total -= size
+
+
+class ResultCache(SqliteIndex):
+    """
+    Sanitized extraction results keyed by the document's sha256 plus fingerprints of the
+    extractor & sanitizers, so any change to either simply stops matching old entries.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS results "
+        "(key TEXT PRIMARY KEY, text BLOB, size INTEGER, used REAL)",
+        "CREATE INDEX IF NOT EXISTS results_used ON results (used)",
+    )
+
+    def __init__(self, root=CACHE_DIR, max_mb=RESULT_CACHE_MB):
+        self.max_size = max_mb * 1024 * 1024
+        super().__init__(os.path.join(root, "results.sqlite"))
+
+    @staticmethod
+    def key(digest, extractor, sanitizers, metadata):
+        # extractors may branch on media type & title (e.g. handle_delaware)
+        parts = (digest, extractor, sanitizers, metadata["media_type"], metadata["title"])
+        return hashlib.sha256("\0".join(parts).encode("utf8")).hexdigest()
+
+    def get(self, key):
+        row = self.db.execute("SELECT text FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+        return zlib.decompress(row[0]).decode("utf8")
+
+    def put(self, key, text):
+        data = zlib.compress(text.encode("utf8"))
+        self.db.execute(
+            "INSERT OR REPLACE INTO results (key, text, size, used) VALUES (?, ?, ?, ?)",
+            (key, data, len(data), time.time()),
+        )
+        self.evict()
+
+    def evict(self):
+        """ drop least recently used results until the cache fits in max_size """
+        (total,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_size:
+            return
+        rows = self.db.execute("SELECT key, size FROM results ORDER BY used").fetchall()
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+
+
+class LinkStats(SqliteIndex):
+    """
+    Running totals per jurisdiction & media type of attempts to get text from a link:
+    how often it worked, and the time & bytes it took, used to pick which link to try first.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS link_stats "
+        "(jurisdiction TEXT, media_type TEXT, attempts INTEGER, successes INTEGER, "
+        "seconds REAL, bytes INTEGER, PRIMARY KEY (jurisdiction, media_type))",
+    )
+
+    def __init__(self, root=CACHE_DIR):
+        super().__init__(os.path.join(root, "link_stats.sqlite"))
+
+    def record(self, jurisdiction, media_type, seconds, n_bytes, ok):
+        self.db.execute(
+            "INSERT INTO link_stats VALUES (?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT (jurisdiction, media_type) DO UPDATE SET "
+            "attempts = attempts + 1, successes = successes + excluded.successes, "
+            "seconds = seconds + excluded.seconds, bytes = bytes + excluded.bytes",
+            (jurisdiction, media_type, int(ok), seconds, n_bytes),
+        )
+
+    def for_jurisdiction(self, jurisdiction):
+        """ {media_type: (attempts, successes, seconds, bytes)} """
+        rows = self.db.execute(
+            "SELECT media_type, attempts, successes, seconds, bytes FROM link_stats "
+            "WHERE jurisdiction = ?",
+            (jurisdiction,),
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    @staticmethod
+    def expected_cost(stats, size=None):
+        """
+        expected seconds spent per success: mean time per attempt (scaled by size against
+        the mean size when it's known) over the success rate, smoothed for few attempts
+        """
+        attempts, successes, seconds, n_bytes = stats
+        mean_seconds = seconds / attempts
+        if size and n_bytes:
+            mean_seconds *= size / (n_bytes / attempts)
+        return mean_seconds / ((successes + 1) / (attempts + 2))
@@ -1,4 +1,5 @@
-from .utils import jid_to_abbr
+import functools
+from .utils import jid_to_abbr, code_fingerprint
 from .common import (
     extract_simple_pdf,
     extract_line_numbered_pdf,
@@ -10,9 +11,10 @@ from .common import (
     extractor_for_element_by_id,
     extractor_for_element_by_xpath,
     extract_from_code_tags_html,
-    textract_extractor,
 )
 from .de import handle_delaware
+from .ocr import extract_hybrid_ocr_pdf
+from .word import extract_doc, extract_docx
 
 
 class DoNotDownload:
@@ -36,7 +38,7 @@ CONVERSION_FUNCTIONS = {
     },
     "co": {"application/pdf": extract_sometimes_numbered_pdf},
     "ct": {"text/html": extract_from_p_tags_html, "application/pdf": DoNotDownload},
-    "dc": {"application/pdf": textract_extractor(extension="pdf", method="tesseract")},
+    "dc": {"application/pdf": extract_hybrid_ocr_pdf},
     "de": {
         "text/html": handle_delaware,
         "application/pdf": handle_delaware,
@@ -92,8 +94,8 @@ CONVERSION_FUNCTIONS = {
     "tn": {"application/pdf": extract_simple_pdf},
     "ut": {"application/pdf": extract_line_numbered_pdf},
     "pr": {
-        "application/msword": textract_extractor(extension="doc"),
-        DOCX_MIMETYPE: textract_extractor(extension="docx"),
+        "application/msword": extract_doc,
+        DOCX_MIMETYPE: extract_docx,
     },
     "pa": {
         "application/msword": DoNotDownload,
@@ -102,10 +104,10 @@ CONVERSION_FUNCTIONS = {
     },
     "ri": {"application/pdf": extract_sometimes_numbered_pdf},
     # aggressive, but the Washington & Texas HTML are both basically bare
-    "tx": {"text/html": extractor_for_element_by_xpath("//html")},
+    "tx": {"text/html": extractor_for_element_by_xpath("//html", streaming=True)},
     "va": {"text/html": extractor_for_element_by_id("mainC")},
     "vt": {"application/pdf": extract_sometimes_numbered_pdf},
-    "wa": {"text/html": extractor_for_element_by_xpath("//html")},
+    "wa": {"text/html": extractor_for_element_by_xpath("//html", streaming=True)},
     "wi": {"application/pdf": extract_sometimes_numbered_pdf, "text/html": DoNotDownload},
     "wv": {"text/html": extractor_for_element_by_xpath('.//*[@class="textcontainer"]')},
     "wy": {"application/pdf": extract_sometimes_numbered_pdf},
@@ -118,5 +120,21 @@ def get_extract_func(metadata):
         func = CONVERSION_FUNCTIONS[state][metadata["media_type"]]
     except KeyError:
         print(f"no function for {state}, {metadata['media_type']}")
-        return lambda data, metadata: ""
+        return no_extractor
     return func
+
+
+def no_extractor(data, metadata):
+    """ what get_extract_func returns without a function, picklable for run_limited """
+    return ""
+
+
+@functools.lru_cache(maxsize=None)
+def extractor_fingerprint(func):
+    """ identity & version of a CONVERSION_FUNCTIONS entry, changes whenever its code does """
+    return code_fingerprint(func)
+
+
+def extractor_name(func):
+    """ readable label for a CONVERSION_FUNCTIONS entry, factories are named after the factory """
+    return func.__qualname__.split(".<locals>")[0]
@@ -1,8 +1,8 @@
 import re
-import tempfile
-import textract
 
+from .document import as_document
 from .utils import (
+    compile_selector,
     pdfdata_to_text,
     text_after_line_numbers,
     text_before_line_numbers,
@@ -10,8 +10,13 @@ from .utils import (
     text_from_element_xpath,
     text_from_element_siblings_lxml,
     text_from_element_siblings_xpath,
+    text_from_tag_streaming,
 )
 
+PRE_TAGS = compile_selector(".//pre")
+P_TAGS = compile_selector(".//p")
+CODE_TAGS = compile_selector(".//code")
+
 
 def extract_simple_pdf(data, metadata):
     return pdfdata_to_text(data)
@@ -25,6 +30,14 @@ def extract_line_post_numbered_pdf(data, metadata):
     return text_before_line_numbers(pdfdata_to_text(data))
 
 
+# Looking for lines that begin with a number
+NUMBERED_LINE_RE = re.compile(r"^\s*\d+\s+(.*)", flags=re.MULTILINE)
+
+# If more than 10% of the text begins with numbers, then we are
+# probably looking at a bill with numbered lines.
+THRESHOLD_NUMBERED_PDF = 0.10
+
+
 def extract_sometimes_numbered_pdf(data, metadata):
     """
     A few states have bills both with numbered lines and without.
@@ -32,23 +45,17 @@ def extract_sometimes_numbered_pdf(data, metadata):
     to determine which extraction function to use.
     """
 
+    # convert once, the same text is classified and then (maybe) stripped
     pdf_text = pdfdata_to_text(data)
-    lines = pdf_text.split("\n")
+    number_of_lines = pdf_text.count("\n") + 1
+    number_of_numbered_lines = sum(1 for _ in NUMBERED_LINE_RE.finditer(pdf_text))
 
-    # Looking for lines that begin with a number
-    pattern = re.compile(r"^\s*\d+\s+(.*)", flags=re.MULTILINE)
-    number_of_numbered_lines = pattern.findall(pdf_text)
-
-    # If more than 10% of the text begins with numbers, then we are
-    # probably looking at a bill with numbered lines.
-    THRESHOLD_NUMBERED_PDF = 0.10
-
-    ratio_of_numbered_lines = len(number_of_numbered_lines) / len(lines)
+    ratio_of_numbered_lines = number_of_numbered_lines / number_of_lines
 
     if ratio_of_numbered_lines > THRESHOLD_NUMBERED_PDF:
-        return extract_line_numbered_pdf(data, metadata)
+        return text_after_line_numbers(pdf_text)
     else:
-        return extract_simple_pdf(data, metadata)
+        return pdf_text
 
 
 def extract_pre_tag_html(data, metadata):
@@ -57,7 +64,7 @@ def extract_pre_tag_html(data, metadata):
     have the text inside <pre> tags (for preformatted text).
     """
 
-    text_inside_matching_tag = text_from_element_lxml(data, ".//pre")
+    text_inside_matching_tag = text_from_element_lxml(data, PRE_TAGS)
     return text_after_line_numbers(text_inside_matching_tag)
 
 
@@ -67,7 +74,7 @@ def extract_from_p_tags_html(data, metadata):
     the text in paragraph tags on the page. There may be several paragraphs.
     """
 
-    text = text_from_element_siblings_lxml(data, ".//p")
+    text = text_from_element_siblings_lxml(data, P_TAGS)
     return text
 
 
@@ -80,26 +87,42 @@ def extractor_for_element_by_id(bill_text_element_id):
 
 
 def extractor_for_element_by_selector(bill_text_element_selector):
+    selector = compile_selector(bill_text_element_selector)
+
     def _my_extractor(data, metadata):
-        text_inside_matching_tag = text_from_element_lxml(data, bill_text_element_selector)
+        text_inside_matching_tag = text_from_element_lxml(data, selector)
         return text_inside_matching_tag
 
     return _my_extractor
 
 
-def extractor_for_element_by_xpath(bill_text_element_selector):
+def extractor_for_element_by_xpath(bill_text_element_selector, streaming=False):
+    """
+    With streaming=True the selector must be a bare //tag: the page is streamed through
+    the parser and only that element's text is kept, no tree is built for the page.
+    """
+    if streaming:
+        tag = re.fullmatch(r"//(\w+)", bill_text_element_selector).group(1)
+
+        def _my_extractor(data, metadata):
+            return text_from_tag_streaming(data, tag)
+
+        return _my_extractor
+
+    selector = compile_selector(bill_text_element_selector)
+
     def _my_extractor(data, metadata):
-        text_inside_matching_tag = text_from_element_xpath(data, bill_text_element_selector)
+        text_inside_matching_tag = text_from_element_xpath(data, selector)
         return text_inside_matching_tag
 
     return _my_extractor
 
 
 def extractor_for_elements_by_xpath(bill_text_element_selector):
+    selector = compile_selector(bill_text_element_selector)
+
     def _my_extractor(data, metadata):
-        text_inside_matching_tag = text_from_element_siblings_xpath(
-            data, bill_text_element_selector
-        )
+        text_inside_matching_tag = text_from_element_siblings_xpath(data, selector)
         return text_inside_matching_tag
 
     return _my_extractor
@@ -110,10 +133,12 @@ def textract_extractor(**kwargs):
     assert "extension" in kwargs, "Must supply extension"
 
     def func(data, metadata):
-        with tempfile.NamedTemporaryFile(delete=False) as tmpf:
-            tmpf.write(data)
-            tmpf.flush()
-            return textract.process(tmpf.name, **kwargs).decode()
+        # only imported when needed, it pulls in a long chain of parsers
+        import textract
+
+        # textract goes by the extension argument, so the downloaded file can be used as is
+        with as_document(data) as document:
+            return textract.process(document.path, **kwargs).decode()
 
     return func
 
@@ -123,6 +148,6 @@ def extract_from_code_tags_html(data, metadata):
     Some states (e.g. IL) have the bill text inside
     <code> tags (as it renders as fixed-width).
     """
-    text = text_from_element_siblings_lxml(data, ".//code")
+    text = text_from_element_siblings_lxml(data, CODE_TAGS)
     return text
 
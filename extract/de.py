@@ -6,12 +6,12 @@ from .common import extractor_for_elements_by_xpath, extract_line_numbered_pdf
 # rather than the Docx link.
 # Docxes are ignored, PDFs will be handled IFF 'HCR' is in the title.
 
+extract_delaware_html = extractor_for_elements_by_xpath("/html/body/div[2] | /html/body/div[3]")
+
 
 def handle_delaware(data, metadata):
     if metadata["media_type"] == "text/html" and "HCR" not in metadata["title"]:
-        return extractor_for_elements_by_xpath("/html/body/div[2] | /html/body/div[3]")(
-            data, metadata
-        )
+        return extract_delaware_html(data, metadata)
     elif metadata["media_type"] == "application/pdf" and "HCR" not in metadata["title"]:
         # Del., like many states, appears to publish all bills as both text and HTML
         # so we don't *need* to extract from PDF.
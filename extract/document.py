@@ -0,0 +1,105 @@
+import os
+import mmap
+import hashlib
+import tempfile
+
+# bytes handed to a parser at a time when feeding it from a memory map
+CHUNK_SIZE = 1024 * 1024
+
+
+class Document:
+    """
+    A document handed to an extractor without copying it around.
+
+    Tools that read files (pdftotext, antiword, zipfile) get `path`, usually the file the
+    download was streamed into, and parsers get `buffer`, a read-only memory map of it.
+    Plain bytes (or a memoryview) work too & are only written to a temporary file if
+    something needs a path.
+    """
+
+    def __init__(self, path=None, data=None, digest=None):
+        assert (path is None) != (data is None), "Must supply exactly one of path or data"
+        self._path = path
+        self._data = data
+        self._digest = digest
+        self._mmap = None
+        self._tmp_path = None
+
+    @property
+    def on_disk(self):
+        return self._path is not None
+
+    @property
+    def path(self):
+        if self._path is not None:
+            return self._path
+        if self._tmp_path is None:
+            fd, self._tmp_path = tempfile.mkstemp()
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._data)
+        return self._tmp_path
+
+    @property
+    def buffer(self):
+        if self._data is not None:
+            return self._data
+        if self._mmap is None:
+            with open(self._path, "rb") as f:
+                # an empty file can't be mapped
+                if os.fstat(f.fileno()).st_size == 0:
+                    self._data = b""
+                    return self._data
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def read(self):
+        """ the whole document as bytes, for parsers that can't take a buffer """
+        if self._data is not None:
+            return bytes(self._data)
+        with open(self._path, "rb") as f:
+            return f.read()
+
+    def chunks(self, size=CHUNK_SIZE):
+        buffer = self.buffer
+        for start in range(0, len(buffer), size):
+            # bytes, a parser's feed() won't take a memoryview
+            yield bytes(buffer[start : start + size])
+
+    @property
+    def digest(self):
+        """ sha256 hex digest, hashed straight from the buffer """
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.buffer).hexdigest()
+        return self._digest
+
+    def __reduce__(self):
+        # sent to another process, e.g. for run_limited, by path when there is one
+        if self._path is not None:
+            return Document, (self._path, None, self._digest)
+        return Document, (None, bytes(self._data), self._digest)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._tmp_path is not None:
+            os.remove(self._tmp_path)
+            self._tmp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def as_document(data):
+    """ extractors accept a Document or plain bytes """
+    return data if isinstance(data, Document) else Document(data=data)
+
+
+def as_bytes(data):
+    return data.read() if isinstance(data, Document) else data
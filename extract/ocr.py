@@ -0,0 +1,100 @@
+import os
+import hashlib
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from .pdf import get_pdf_backend
+from .document import as_document
+
+# OCR output is cached per rendered page, so pages shared between versions are OCR'd once
+OCR_CACHE_DIR = os.path.join(os.environ.get("TEXT_EXTRACT_CACHE_DIR", "cache"), "ocr")
+# pages OCR'd at once, each is its own pdftoppm & tesseract process
+OCR_WORKERS = int(os.environ.get("TEXT_EXTRACT_OCR_WORKERS", os.cpu_count() or 1))
+# pdftoppm's default resolution, the one textract rendered pages at
+OCR_DPI = 150
+
+
+def _run(args):
+    try:
+        proc = subprocess.run(
+            args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, close_fds=True, check=True
+        )
+    except OSError as e:
+        raise EnvironmentError(f"error running {args[0]}, missing executable? [{e}]")
+    return proc.stdout
+
+
+def _cache_path(digest):
+    return os.path.join(OCR_CACHE_DIR, digest[:2], digest + ".txt")
+
+
+def _cache_get(digest):
+    try:
+        with open(_cache_path(digest), encoding="utf8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _cache_put(digest, text):
+    path = _cache_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # unique per thread too, other pages may be writing the same image's text
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def render_page(pdf_path, page, workdir):
+    """ render one page (numbered from 1), returning the image's digest & path """
+    prefix = os.path.join(workdir, f"page-{page}")
+    _run(
+        ["pdftoppm", "-r", str(OCR_DPI), "-f", str(page), "-l", str(page)]
+        + ["-png", "-singlefile", pdf_path, prefix]
+    )
+    image = prefix + ".png"
+    with open(image, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return digest, image
+
+
+def ocr_image(digest, image):
+    """ OCR a rendered page, unless the same image was OCR'd before """
+    text = _cache_get(digest)
+    if text is None:
+        text = _run(["tesseract", image, "stdout"]).decode("utf8", "ignore")
+        _cache_put(digest, text)
+    return text
+
+
+def extract_hybrid_ocr_pdf(data, metadata):
+    """
+    Text layer where a page has one, OCR for the pages that are only an image.
+
+    The whole document is converted once, pdftotext ends each page with a form feed so
+    the pages that came back empty are the scanned ones, and those are OCR'd in parallel.
+    """
+    document = as_document(data)
+    pages = get_pdf_backend().to_text(document).split("\f")
+    if len(pages) > 1 and not pages[-1]:
+        pages.pop()
+    scanned = [i for i, text in enumerate(pages) if not text.strip()]
+    if scanned:
+        # rendered pages (& any copy of the PDF) are removed even when OCR fails
+        with tempfile.TemporaryDirectory() as workdir:
+            if document.on_disk:
+                pdf_path = document.path
+            else:
+                pdf_path = os.path.join(workdir, "document.pdf")
+                with open(pdf_path, "wb") as f:
+                    f.write(document.buffer)
+            with ThreadPoolExecutor(max_workers=min(OCR_WORKERS, len(scanned))) as pool:
+                rendered = list(pool.map(lambda i: render_page(pdf_path, i + 1, workdir), scanned))
+                # blank & separator pages repeat, each distinct image is only OCR'd once
+                images = dict(rendered)
+                texts = dict(zip(images, pool.map(lambda d: ocr_image(d, images[d]), images)))
+                for i, (digest, _) in zip(scanned, rendered):
+                    pages[i] = texts[digest]
+    return "\n".join(pages)
@@ -0,0 +1,82 @@
+import os
+import functools
+import subprocess
+from .document import as_document
+
+# which backend pdfdata_to_text uses, e.g. TEXT_EXTRACT_PDF_BACKEND=poppler
+DEFAULT_PDF_BACKEND = os.environ.get("TEXT_EXTRACT_PDF_BACKEND", "pdftotext")
+
+
+class PdftotextBackend:
+    """ poppler's pdftotext -layout, reading the downloaded file or stdin """
+
+    name = "pdftotext"
+
+    def to_text(self, data):
+        document = as_document(data)
+        # a downloaded file is read in place, bytes are streamed over stdin
+        if document.on_disk:
+            args, data = ["pdftotext", "-layout", document.path, "-"], None
+        else:
+            args, data = ["pdftotext", "-layout", "-", "-"], document.buffer
+        try:
+            # run() feeds stdin while draining stdout and always reaps the child
+            proc = subprocess.run(
+                args,
+                input=data,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                close_fds=True,
+            )
+        except OSError as e:
+            raise EnvironmentError(f"error running pdftotext, missing executable? [{e}]")
+        return proc.stdout.decode("utf8", "ignore")
+
+
+class PopplerBackend:
+    """ in-process poppler-cpp through python-poppler, no fork or temporary file per document """
+
+    name = "poppler"
+
+    def __init__(self):
+        try:
+            import poppler
+        except ImportError as e:
+            raise EnvironmentError(f"poppler backend requires python-poppler [{e}]")
+        self.poppler = poppler
+
+    def to_text(self, data):
+        document = as_document(data)
+        if document.on_disk:
+            document = self.poppler.load_from_file(document.path)
+        else:
+            document = self.poppler.load_from_data(bytes(document.buffer))
+        layout = self.poppler.TextLayout.physical_layout
+        # pdftotext ends every page with a form feed, do the same so output matches
+        pages = []
+        for i in range(document.pages):
+            pages.append(document.create_page(i).text(layout_mode=layout))
+            pages.append("\f")
+        return "".join(pages)
+
+
+PDF_BACKENDS = {backend.name: backend for backend in (PdftotextBackend, PopplerBackend)}
+
+_current = DEFAULT_PDF_BACKEND
+
+
+def set_pdf_backend(name):
+    global _current
+    if name not in PDF_BACKENDS:
+        raise ValueError(f"unknown pdf backend {name}, choose from {', '.join(PDF_BACKENDS)}")
+    _current = name
+
+
+@functools.lru_cache(maxsize=None)
+def _load_backend(name):
+    return PDF_BACKENDS[name]()
+
+
+def get_pdf_backend(name=None):
+    """ the named (or configured) backend, instantiated once per process """
+    return _load_backend(name or _current)
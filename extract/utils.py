@@ -1,9 +1,13 @@
+import os
 import re
-import tempfile
+import types
+import hashlib
 import functools
-import subprocess
 
-from lxml import html
+from lxml import etree, html
+
+from .pdf import get_pdf_backend
+from .document import Document, as_bytes
 
 
 def jid_to_abbr(j):
@@ -19,19 +23,119 @@ def abbr_to_jid(abbr):
         return f"ocd-jurisdiction/country:us/state:{abbr}/government"
 
 
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _is_repo_code(obj):
+    filename = getattr(getattr(obj, "__code__", None), "co_filename", "")
+    return filename.startswith(_REPO_ROOT) and "site-packages" not in filename
+
+
+def _code_parts(code):
+    yield code.co_code
+    yield repr(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _code_parts(const)
+        elif isinstance(const, frozenset):
+            # set ordering depends on the hash seed, so sort to stay stable across runs
+            yield repr(sorted(const, key=repr))
+        else:
+            yield repr(const)
+
+
+def _global_names(code):
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _global_names(const)
+
+
+SCALARS = (str, int, float, bytes, bool, type(None))
+
+
+def _fingerprint_parts(obj, seen):
+    # scalars are always emitted, a repeated value is still part of the behavior
+    if isinstance(obj, SCALARS):
+        yield repr(obj)
+        return
+    # everything else is only expanded once, which also stops recursion
+    if id(obj) in seen:
+        yield f"<seen {type(obj).__qualname__} {getattr(obj, '__qualname__', '')}>"
+        return
+    seen.add(id(obj))
+
+    if isinstance(obj, functools.partial):
+        yield "partial"
+        yield from _fingerprint_parts(obj.func, seen)
+        for arg in obj.args + tuple(sorted(obj.keywords.items())):
+            yield from _fingerprint_parts(arg, seen)
+    elif isinstance(obj, types.FunctionType):
+        yield obj.__qualname__
+        if not _is_repo_code(obj):
+            return
+        yield from _code_parts(obj.__code__)
+        for default in obj.__defaults__ or ():
+            yield from _fingerprint_parts(default, seen)
+        # values captured by extractor factories, e.g. the selector of an element extractor
+        for cell in obj.__closure__ or ():
+            yield from _fingerprint_parts(cell.cell_contents, seen)
+        # helpers called by name, e.g. pdfdata_to_text inside extract_line_numbered_pdf
+        for name in sorted(set(_global_names(obj.__code__))):
+            if name in obj.__globals__:
+                yield name
+                yield from _fingerprint_parts(obj.__globals__[name], seen)
+    elif isinstance(obj, type):
+        yield obj.__qualname__
+        for attr in sorted(vars(obj)):
+            value = vars(obj)[attr]
+            if isinstance(value, (types.FunctionType,) + SCALARS):
+                yield attr
+                yield from _fingerprint_parts(value, seen)
+        for base in obj.__bases__:
+            yield from _fingerprint_parts(base, seen)
+    elif isinstance(obj, re.Pattern):
+        yield repr((obj.pattern, obj.flags))
+    elif isinstance(obj, etree.XPath):
+        yield obj.path
+    elif isinstance(obj, (tuple, list)):
+        # the length keeps e.g. ((1,), (2,)) & ((1, 2),) apart
+        yield f"{type(obj).__name__}({len(obj)})"
+        for item in obj:
+            yield from _fingerprint_parts(item, seen)
+    elif isinstance(obj, (set, frozenset)):
+        yield repr(sorted(obj, key=repr))
+    elif isinstance(obj, dict):
+        yield f"dict({len(obj)})"
+        for key, value in sorted(obj.items(), key=lambda item: repr(item[0])):
+            yield repr(key)
+            yield from _fingerprint_parts(value, seen)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, types.ModuleType):
+        # an instance, e.g. a Sanitizer: its class plus its attributes
+        yield from _fingerprint_parts(type(obj), seen)
+        for attr, value in sorted(vars(obj).items()):
+            yield attr
+            yield from _fingerprint_parts(value, seen)
+    else:
+        yield type(obj).__name__
+
+
+def code_fingerprint(obj):
+    """
+    Hash of the code & captured values behind a callable (or object), including the
+    repository helpers it calls, so it changes whenever the behavior could change.
+    """
+    digest = hashlib.sha256()
+    for part in _fingerprint_parts(obj, set()):
+        part = part if isinstance(part, bytes) else part.encode("utf8", "replace")
+        # length prefixed, so parts can't run together into the same bytes
+        digest.update(b"%d:" % len(part))
+        digest.update(part)
+    return digest.hexdigest()
+
+
 def pdfdata_to_text(data):
-    with tempfile.NamedTemporaryFile(delete=True) as tmpf:
-        tmpf.write(data)
-        tmpf.flush()
-        try:
-            pipe = subprocess.Popen(
-                ["pdftotext", "-layout", tmpf.name, "-"], stdout=subprocess.PIPE, close_fds=True
-            ).stdout
-        except OSError as e:
-            raise EnvironmentError(f"error running pdftotext, missing executable? [{e}]")
-        data = pipe.read()
-        pipe.close()
-        return data.decode("utf8", "ignore")
+    return get_pdf_backend().to_text(data)
 
 
 # def clean(text):
@@ -42,67 +146,171 @@ def pdfdata_to_text(data):
 #     return text
 
 
-def _text_near_line_numbers(lines, regex):
-    """ used for before & after line numbers """
-    text = []
-    for line in lines.splitlines():
-        # real bill text starts with an optional space, line number,
-        # more spaces, then real text
-        match = re.match(regex, line)
-        if match:
-            text.append(match.group(1))
+# everything str.splitlines() treats as a line boundary
+_LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+# the start of the text, or just after a line boundary
+_LINE_START = f"(?:^|(?<=[{_LINE_BREAKS}]))"
+# whitespace that doesn't end the line
+_INLINE_SPACE = f"[^\\S{_LINE_BREAKS}]"
+_LINE_REST = f"[^{_LINE_BREAKS}]"
+
+
+class LineNumberStripper:
+    """
+    Keeps the text beside line numbers using a single compiled scan over the whole text,
+    with the same results as matching the per-line regex against each of text.splitlines().
+
+    Text can also be fed in chunks (e.g. as it's read from a converter) with strip_chunks.
+    """
+
+    def __init__(self, text_regex):
+        # every match consumes a whole line, so the scan never retries mid-line positions;
+        # lines without a line number match the second branch and leave group 1 unset
+        self.regex = re.compile(f"{_LINE_START}(?:{text_regex}{_LINE_REST}*|{_LINE_REST}+)")
+
+    def _matches(self, text):
+        return [match.group(1) for match in self.regex.finditer(text) if match.lastindex]
+
+    def strip(self, text):
+        # return all real bill text joined w/ newlines
+        return "\n".join(self._matches(text))
 
-    # return all real bill text joined w/ newlines
-    return "\n".join(text)
+    def strip_chunks(self, chunks):
+        matches = []
+        pending = ""
+        for chunk in chunks:
+            pending += chunk
+            # only scan complete lines, the rest waits for the next chunk
+            end = max(pending.rfind(char) for char in _LINE_BREAKS) + 1
+            if end:
+                matches.extend(self._matches(pending[:end]))
+                pending = pending[end:]
+        matches.extend(self._matches(pending))
+        return "\n".join(matches)
 
+    def __call__(self, text):
+        if isinstance(text, str):
+            return self.strip(text)
+        return self.strip_chunks(text)
 
-text_after_line_numbers = functools.partial(_text_near_line_numbers, regex=r"\s*\d+\s+(.*)")
-text_before_line_numbers = functools.partial(_text_near_line_numbers, regex=r"(.*?)\s+\d+\s*")
+
+# real bill text starts with an optional space, line number,
+# more spaces, then real text (per line: \s*\d+\s+(.*))
+text_after_line_numbers = LineNumberStripper(
+    f"{_INLINE_SPACE}*\\d+{_INLINE_SPACE}+({_LINE_REST}*)"
+)
+# or real text, more spaces, then the line number (per line: (.*?)\s+\d+\s*)
+text_before_line_numbers = LineNumberStripper(f"({_LINE_REST}*?){_INLINE_SPACE}+\\d+")
+
+
+def compile_selector(query):
+    """
+    Compile a selector once, when an extractor is registered, rather than for every document.
+    The ElementPath selectors used with findall (e.g. .//div[@id='x']) are valid XPath too.
+    """
+    return etree.XPath(query)
+
+
+def _as_xpath(query):
+    return query if isinstance(query, etree.XPath) else etree.XPath(query)
+
+
+def _select(html_document, query):
+    if isinstance(query, etree.XPath):
+        return query(html_document)
+    return html_document.findall(query)
+
+
+def _query_text(query):
+    return query.path if isinstance(query, etree.XPath) else query
 
 
 def text_from_element_lxml(data, lxml_query):
-    html_document = html.fromstring(data)
-    matching_elements = html_document.findall(lxml_query)
+    html_document = html.fromstring(as_bytes(data))
+    matching_elements = _select(html_document, lxml_query)
 
     # To ensure that we exit non-zero if there are multiple matching elements
     # on the page, raise an exception: this means that the extraction
     # code needs to be updated.
-    assert len(matching_elements) == 1, f"{len(matching_elements)} matches for {lxml_query}"
+    assert (
+        len(matching_elements) == 1
+    ), f"{len(matching_elements)} matches for {_query_text(lxml_query)}"
 
     text_inside_element = matching_elements[0].text_content()
     return text_inside_element
 
 
 def text_from_element_xpath(data, lxml_xpath_query):
-    html_document = html.fromstring(data)
-    matching_elements = html_document.xpath(lxml_xpath_query)
+    html_document = html.fromstring(as_bytes(data))
+    matching_elements = _select(html_document, _as_xpath(lxml_xpath_query))
 
     # To ensure that we exit non-zero if there are multiple matching elements
     # on the page, raise an exception: this means that the extraction
     # code needs to be updated.
-    assert len(matching_elements) == 1, f"{len(matching_elements)} matches for {lxml_xpath_query}"
+    assert (
+        len(matching_elements) == 1
+    ), f"{len(matching_elements)} matches for {_query_text(lxml_xpath_query)}"
 
     text_inside_element = matching_elements[0].text_content()
     return text_inside_element
 
 
-def text_from_element_siblings_lxml(data, lxml_query):
-    html_document = html.fromstring(data)
-    matching_elements = html_document.findall(lxml_query)
+class _TagTextCollector:
+    """ parser target that keeps only the text inside <tag> elements, never building a tree """
 
-    text_inside_elements = ""
-    for element in matching_elements:
-        text_inside_elements += element.text_content() + "\n"
+    def __init__(self, tag):
+        self.tag = tag
+        self.depth = 0
+        self.matches = 0
+        self.text = []
 
-    return text_inside_elements
+    def start(self, tag, attrib):
+        if tag == self.tag:
+            self.matches += 1
+            self.depth += 1
 
+    def end(self, tag):
+        if tag == self.tag:
+            self.depth -= 1
 
-def text_from_element_siblings_xpath(data, lxml_query):
-    html_document = html.fromstring(data)
-    matching_elements = html_document.xpath(lxml_query)
+    def data(self, data):
+        if self.depth:
+            self.text.append(data)
+
+    def close(self):
+        return self.matches, "".join(self.text)
 
-    text_inside_elements = ""
-    for element in matching_elements:
-        text_inside_elements += element.text_content() + "\n"
 
-    return text_inside_elements
+def text_from_tag_streaming(data, tag):
+    """
+    Same result as text_from_element_xpath(data, f"//{tag}"), but the page is streamed
+    through the parser and only text inside the matching element is kept, which matters
+    for very large pages where the whole document is the bill (e.g. TX & WA //html).
+    """
+    parser = etree.HTMLParser(target=_TagTextCollector(tag))
+    if isinstance(data, Document):
+        # fed from the memory map a chunk at a time, the page is never copied whole
+        for chunk in data.chunks():
+            parser.feed(chunk)
+        matches, text = parser.close()
+    else:
+        matches, text = etree.fromstring(data, parser)
+
+    # same check as text_from_element_xpath: more than one match needs new extraction code
+    assert matches == 1, f"{matches} matches for //{tag}"
+
+    return text
+
+
+def text_from_element_siblings_lxml(data, lxml_query):
+    html_document = html.fromstring(as_bytes(data))
+    matching_elements = _select(html_document, lxml_query)
+
+    return "".join(element.text_content() + "\n" for element in matching_elements)
+
+
+def text_from_element_siblings_xpath(data, lxml_query):
+    html_document = html.fromstring(as_bytes(data))
+    matching_elements = _select(html_document, _as_xpath(lxml_query))
+
+    return "".join(element.text_content() + "\n" for element in matching_elements)
@@ -0,0 +1,72 @@
+import io
+import re
+import zipfile
+import subprocess
+from lxml import etree
+from .document import as_document
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_T = W_NS + "t"
+W_P = W_NS + "p"
+# what docx2txt puts in the text where these elements start
+W_MARKS = {W_NS + "tab": "\t", W_NS + "br": "\n", W_NS + "cr": "\n", W_P: "\n\n"}
+
+HEADER_XMLS = re.compile(r"word/header[0-9]*.xml")
+FOOTER_XMLS = re.compile(r"word/footer[0-9]*.xml")
+
+
+def _xml_text(stream, parts):
+    """
+    the text of one part of a DOCX, the same as docx2txt's xml2text, parsed incrementally
+    so finished paragraphs can be dropped instead of holding the whole tree
+    """
+    for event, element in etree.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            mark = W_MARKS.get(element.tag)
+            if mark:
+                parts.append(mark)
+        elif element.tag == W_T:
+            # nothing else can be emitted inside a w:t, so its end is as good as its start
+            parts.append(element.text or "")
+        elif element.tag == W_P:
+            element.clear()
+
+
+def extract_docx(data, metadata):
+    """ headers, body, then footers, matching what textract got from docx2txt """
+    parts = []
+    document = as_document(data)
+    # zipfile seeks around the central directory, straight from the file when there is one
+    source = document.path if document.on_disk else io.BytesIO(document.buffer)
+    with zipfile.ZipFile(source) as docx:
+        names = docx.namelist()
+        headers = [name for name in names if HEADER_XMLS.match(name)]
+        footers = [name for name in names if FOOTER_XMLS.match(name)]
+        for name in headers + ["word/document.xml"] + footers:
+            with docx.open(name) as stream:
+                _xml_text(stream, parts)
+    return "".join(parts).strip()
+
+
+def extract_doc(data, metadata):
+    """ legacy Word documents through antiword, decoded the way textract did it """
+    import chardet
+
+    # antiword only reads files, bytes get a temporary one that the Document removes
+    with as_document(data) as document:
+        try:
+            proc = subprocess.run(
+                ["antiword", document.path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True,
+            )
+        except OSError as e:
+            raise EnvironmentError(f"error running antiword, missing executable? [{e}]")
+    if proc.returncode != 0:
+        raise ValueError(f"antiword failed: {proc.stderr.decode('utf8', 'ignore').strip()}")
+    if not proc.stdout:
+        return ""
+    encoding = chardet.detect(proc.stdout)["encoding"]
+    # textract re-encoded as utf8, dropping anything that couldn't be
+    return proc.stdout.decode(encoding).encode("utf8", "ignore").decode("utf8")
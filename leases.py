@@ -0,0 +1,136 @@
+import os
+import socket
+import threading
+from contextlib import contextmanager
+from django.db import connection, connections, transaction
+
+TABLE = "text_extraction_work"
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS {TABLE} (
+    bill_id VARCHAR PRIMARY KEY,
+    jurisdiction_id VARCHAR NOT NULL,
+    lease_owner VARCHAR,
+    lease_expires TIMESTAMP WITH TIME ZONE,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+# unleased or expired rows, of one jurisdiction if given, locked rows belong to a worker
+# that is claiming them right now
+CLAIM = f"""
+UPDATE {TABLE} SET lease_owner = %s,
+                   lease_expires = now() + %s * interval '1 second',
+                   attempts = attempts + 1
+WHERE bill_id IN (
+    SELECT bill_id FROM {TABLE}
+    WHERE (lease_expires IS NULL OR lease_expires < now()) AND attempts < %s
+      AND (%s::varchar IS NULL OR jurisdiction_id = %s)
+    ORDER BY jurisdiction_id, bill_id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING bill_id
+"""
+
+
+class WorkQueue:
+    """
+    Bills waiting for text, shared by every `update --distributed` process through a table.
+
+    Workers lease batches of bills, a heartbeat thread keeps their leases alive, and a
+    worker that dies simply stops renewing so its bills become claimable again once the
+    lease expires. Finished bills are deleted in the same transaction as their text.
+    """
+
+    def __init__(self, owner=None, lease_seconds=600, max_attempts=3, jurisdiction_id=None):
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        # a single state's update only claims that state's bills
+        self.jurisdiction_id = jurisdiction_id
+        # a bill that has taken down this many workers is left for a human to look at
+        self.max_attempts = max_attempts
+
+    def _execute(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount, cursor.fetchall() if cursor.description else []
+
+    def create(self):
+        self._execute(SCHEMA)
+
+    def enqueue(self, bills):
+        """ add every bill in the queryset that isn't queued already, returns # added """
+        rows = bills.values_list("id", "legislative_session__jurisdiction_id").order_by()
+        sql, params = rows.query.sql_with_params()
+        insert = f"INSERT INTO {TABLE} (bill_id, jurisdiction_id) {sql} ON CONFLICT DO NOTHING"
+        added, _ = self._execute(insert, params)
+        return added
+
+    def remaining(self):
+        _, rows = self._execute(
+            f"SELECT COUNT(*) FROM {TABLE} WHERE attempts < %s", (self.max_attempts,)
+        )
+        return rows[0][0]
+
+    def claim(self, n):
+        """ lease up to n bills to this worker, returns their ids """
+        params = (self.owner, self.lease_seconds, self.max_attempts)
+        params += (self.jurisdiction_id, self.jurisdiction_id, n)
+        _, rows = self._execute(CLAIM, params)
+        self._commit()
+        return [bill_id for (bill_id,) in rows]
+
+    def _commit(self):
+        # update runs with autocommit off, but only buffers its own writes between
+        # checkpoints, so commit here to make the change visible to other workers now
+        # & not hold row locks the heartbeat's renewal would wait on
+        if not transaction.get_autocommit():
+            transaction.commit()
+
+    def complete(self, bill_ids, commit=False):
+        """ drop finished bills, commits along with the caller's transaction unless commit """
+        if bill_ids:
+            self._execute(
+                f"DELETE FROM {TABLE} WHERE lease_owner = %s AND bill_id = ANY(%s)",
+                (self.owner, list(bill_ids)),
+            )
+            if commit:
+                self._commit()
+
+    def release(self, bill_ids=None):
+        """ hand back the given bills, or any still leased to this worker """
+        sql = (
+            f"UPDATE {TABLE} SET lease_owner = NULL, lease_expires = NULL, "
+            "attempts = attempts - 1 WHERE lease_owner = %s"
+        )
+        if bill_ids is None:
+            self._execute(sql, (self.owner,))
+        elif bill_ids:
+            self._execute(sql + " AND bill_id = ANY(%s)", (self.owner, list(bill_ids)))
+            self._commit()
+
+    @contextmanager
+    def heartbeat(self):
+        """ renew this worker's leases from a background thread while the block runs """
+        stop = threading.Event()
+
+        def renew():
+            try:
+                while not stop.wait(self.lease_seconds / 3):
+                    self._execute(
+                        f"UPDATE {TABLE} SET lease_expires = now() + %s * interval '1 second' "
+                        "WHERE lease_owner = %s",
+                        (self.lease_seconds, self.owner),
+                    )
+            finally:
+                # the thread's own connection, the caller's is untouched
+                connections.close_all()
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,305 @@
+import io
+import os
+import sys
+import json
+import atexit
+import time
+import pickle
+import struct
+import select
+import signal
+import resource
+import threading
+
+# every extraction runs in a child process under these limits: wall clock `seconds`,
+# `cpu_seconds` & `memory_mb`, each applied per process so a pdftotext or tesseract the
+# extractor starts gets its own copy. memory_mb is address space (VSZ), not resident
+# memory, on top of what the child inherited from the process it was forked from
+DEFAULT_LIMITS = {"seconds": 120, "cpu_seconds": 120, "memory_mb": 2048}
+
+# overrides for particular media types & then for particular states
+LIMITS_BY_MEDIA_TYPE = {
+    "text/html": {"seconds": 60, "cpu_seconds": 60},
+}
+LIMITS_BY_STATE = {
+    # OCR, scanned pages take tesseract a while each
+    "dc": {"seconds": 900, "cpu_seconds": 600},
+}
+
+
+class LimitExceeded(Exception):
+    """ an extraction was stopped for using too much of something, see `reason` """
+
+    reason = "limit"
+
+
+class DeadlineExceeded(LimitExceeded):
+    reason = "deadline"
+
+
+class CPULimitExceeded(LimitExceeded):
+    reason = "cpu"
+
+
+class MemoryLimitExceeded(LimitExceeded):
+    reason = "memory"
+
+
+class Limits:
+    """ the limits for each state & media type, the defaults above unless overridden """
+
+    def __init__(self, default=None, media_types=None, states=None):
+        self.default = dict(DEFAULT_LIMITS, **(default or {}))
+        self.media_types = dict(LIMITS_BY_MEDIA_TYPE, **(media_types or {}))
+        self.states = dict(LIMITS_BY_STATE, **(states or {}))
+
+    @classmethod
+    def from_file(cls, filename):
+        """ JSON like {"default": {...}, "media_types": {...}, "states": {...}} """
+        with open(filename) as f:
+            return cls(**json.load(f))
+
+    def for_document(self, state, media_type):
+        limits = dict(self.default)
+        limits.update(self.media_types.get(media_type, {}))
+        limits.update(self.states.get(state, {}))
+        return limits
+
+
+def _address_space():
+    """ bytes of address space this process has mapped, 0 where /proc isn't available """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _apply_rlimits(limits):
+    cpu = int(limits["cpu_seconds"])
+    # SIGXCPU at the soft limit, SIGKILL a little later if that's caught
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 5))
+    # a fork starts out with the parent's address space, download threads' stacks & all,
+    # so the extractor gets memory_mb more than that rather than memory_mb in total
+    memory = _address_space() + int(limits["memory_mb"]) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def _child(func, args, limits, write_fd):
+    try:
+        _apply_rlimits(limits)
+        result = (True, func(*args))
+    except MemoryError:
+        result = (False, MemoryLimitExceeded(f"over {limits['memory_mb']}MB"))
+    except BaseException as e:
+        result = (False, e)
+    try:
+        payload = pickle.dumps(result)
+    except Exception:
+        # exceptions that can't be pickled come back as their description
+        payload = pickle.dumps((False, RuntimeError(repr(result[1]))))
+    with os.fdopen(write_fd, "wb") as f:
+        f.write(payload)
+    # extractors may print, nothing else of the parent's should run in here
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+
+def _kill(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def run_limited(func, args, limits):
+    """
+    func(*args) in a forked child under `limits`, returning its result or raising its
+    exception. The child & anything it started are killed when the deadline passes.
+
+    The child is forked by this process's ForkServer if it started one, otherwise by this
+    process, which must not have other threads running: a fork only copies the calling
+    thread, and a lock another thread held at that moment stays held in the child.
+    """
+    if _server is not None and _server.owner == os.getpid():
+        return _server.run(func, args, limits)
+    return _run_forked(func, args, limits)
+
+
+def _run_forked(func, args, limits):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        # a ForkServer's handlers aren't the extractor's
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # own process group, so a kill takes pdftotext & co. with it
+        os.setpgid(0, 0)
+        _child(func, args, limits, write_fd)
+    os.close(write_fd)
+    try:
+        # set here too, the child may not have gotten that far when it's killed
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+    deadline = time.monotonic() + limits["seconds"]
+    chunks = []
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([read_fd], [], [], remaining)[0]:
+                raise DeadlineExceeded(f"over {limits['seconds']}s")
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except BaseException:
+        # the deadline, or e.g. ^C, which the child's process group doesn't get
+        _kill(pid)
+        raise
+    finally:
+        os.close(read_fd)
+        _, status = os.waitpid(pid, 0)
+        # grandchildren left behind by an extractor that failed part way
+        _kill(pid)
+
+    if os.WIFSIGNALED(status):
+        if os.WTERMSIG(status) in (signal.SIGXCPU, signal.SIGKILL):
+            raise CPULimitExceeded(f"over {limits['cpu_seconds']}s of cpu")
+        raise LimitExceeded(f"killed by signal {os.WTERMSIG(status)}")
+    if not chunks:
+        # e.g. the child couldn't allocate enough memory to send its result
+        raise MemoryLimitExceeded(f"no result, over {limits['memory_mb']}MB?")
+    ok, value = pickle.loads(b"".join(chunks))
+    if not ok:
+        raise value
+    return value
+
+
+def _write_frame(f, payload):
+    f.write(struct.pack("!Q", len(payload)))
+    f.write(payload)
+    f.flush()
+
+
+def _read_frame(f):
+    """ a length prefixed payload, None at EOF """
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    (size,) = struct.unpack("!Q", header)
+    return f.read(size)
+
+
+class ForkServer:
+    """
+    A helper process, forked while the caller is still single-threaded, that forks the
+    limited children for it, so they never come from a process with download or
+    heartbeat threads running.
+
+    Requests are pickled over a pipe. Callables that can't be pickled by name, e.g. the
+    closures extractor factories return, are sent as references to the `known` ones,
+    which the server has its own copy of since it was forked after they were created.
+    """
+
+    def __init__(self, known=()):
+        self._known = {id(obj): obj for obj in known}
+        self._lock = threading.Lock()
+        self.owner = os.getpid()
+        request_read, request_write = os.pipe()
+        response_read, response_write = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(request_write)
+            os.close(response_read)
+            self._serve(os.fdopen(request_read, "rb"), os.fdopen(response_write, "wb"))
+        os.close(request_read)
+        os.close(response_write)
+        self._requests = os.fdopen(request_write, "wb")
+        self._responses = os.fdopen(response_read, "rb")
+
+    def _dumps(self, obj):
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f)
+        pickler.persistent_id = lambda o: id(o) if id(o) in self._known else None
+        pickler.dump(obj)
+        return f.getvalue()
+
+    def _loads(self, payload):
+        unpickler = pickle.Unpickler(io.BytesIO(payload))
+        unpickler.persistent_load = self._known.__getitem__
+        return unpickler.load()
+
+    def _serve(self, requests, responses):
+        # ^C goes to the whole foreground process group, the caller decides what to do
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        def stop(signum, frame):
+            # raised inside _run_forked, which kills the child it's waiting on
+            raise SystemExit(1)
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            while True:
+                request = _read_frame(requests)
+                if request is None:
+                    break
+                try:
+                    func, args, limits = self._loads(request)
+                    result = (True, _run_forked(func, args, limits))
+                except Exception as e:
+                    result = (False, e)
+                try:
+                    payload = self._dumps(result)
+                except Exception:
+                    payload = self._dumps((False, RuntimeError(repr(result[1]))))
+                _write_frame(responses, payload)
+        finally:
+            os._exit(0)
+
+    def run(self, func, args, limits):
+        with self._lock:
+            try:
+                _write_frame(self._requests, self._dumps((func, args, limits)))
+                response = _read_frame(self._responses)
+            except BaseException:
+                # e.g. ^C, don't leave the extraction running
+                self.close(kill=True)
+                raise
+        if response is None:
+            raise RuntimeError("the fork server exited")
+        ok, value = self._loads(response)
+        if not ok:
+            raise value
+        return value
+
+    def close(self, kill=False):
+        global _server
+        # also registered with atexit, which a fork of the owner inherits
+        if os.getpid() != self.owner or self._requests.closed:
+            return
+        if kill:
+            os.kill(self.pid, signal.SIGTERM)
+        self._requests.close()
+        self._responses.close()
+        os.waitpid(self.pid, 0)
+        if _server is self:
+            _server = None
+
+
+_server = None
+
+
+def start_fork_server(known=()):
+    """
+    start this process's ForkServer for run_limited, call it before starting any threads,
+    `known` being the callables it'll be asked to run, it's a no-op once one is running
+    """
+    global _server
+    if _server is None or _server.owner != os.getpid():
+        _server = ForkServer(known)
+        atexit.register(_server.close)
+    return _server
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import heapq
+import marshal
+import cProfile
+from contextlib import contextmanager
+
+STAGES = ("download", "extract", "sanitize", "db_write", "reindex")
+
+# upper bounds in seconds, matching Prometheus' cumulative `le` buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+
+@contextmanager
+def timed(timings, stage, media_type=""):
+    """ append (stage, media_type, seconds) to timings, a plain list that pickles cheaply """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((stage, media_type, time.perf_counter() - start))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += seconds
+        self.count += 1
+
+
+class Metrics:
+    """
+    stage timing histograms labeled by jurisdiction & media type, plus a histogram per
+    sanitizer pass, which time themselves as ("sanitizer", pass name, seconds)
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        # time spent in each sanitizer pass, by (sanitizer, jurisdiction)
+        self.sanitizers = {}
+        # bills saved with is_error, by (reason, jurisdiction)
+        self.errors = {}
+
+    def observe(self, stage, seconds, jurisdiction="", media_type=""):
+        key = (stage, jurisdiction, media_type)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(seconds)
+
+    def observe_sanitizer(self, sanitizer, seconds, jurisdiction=""):
+        key = (sanitizer, jurisdiction)
+        if key not in self.sanitizers:
+            self.sanitizers[key] = Histogram()
+        self.sanitizers[key].observe(seconds)
+
+    def merge(self, timings, jurisdiction=""):
+        for stage, label, seconds in timings:
+            if stage == "sanitizer":
+                self.observe_sanitizer(label, seconds, jurisdiction)
+            else:
+                self.observe(stage, seconds, jurisdiction, label)
+
+    def count_error(self, reason, jurisdiction=""):
+        key = (reason, jurisdiction)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    @contextmanager
+    def timer(self, stage, jurisdiction="", media_type=""):
+        timings = []
+        with timed(timings, stage, media_type):
+            yield
+        self.merge(timings, jurisdiction)
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "stages": [
+                    {
+                        "stage": stage,
+                        "jurisdiction": jurisdiction,
+                        "media_type": media_type,
+                        "count": h.count,
+                        "sum": h.sum,
+                        "buckets": {str(bound): n for bound, n in zip(BUCKETS, h.counts)},
+                    }
+                    for (stage, jurisdiction, media_type), h in sorted(self.histograms.items())
+                ],
+                "sanitizers": [
+                    {
+                        "sanitizer": sanitizer,
+                        "jurisdiction": jurisdiction,
+                        "count": h.count,
+                        "sum": h.sum,
+                        "buckets": {str(bound): n for bound, n in zip(BUCKETS, h.counts)},
+                    }
+                    for (sanitizer, jurisdiction), h in sorted(self.sanitizers.items())
+                ],
+                "errors": [
+                    {"reason": reason, "jurisdiction": jurisdiction, "count": count}
+                    for (reason, jurisdiction), count in sorted(self.errors.items())
+                ],
+            },
+            indent=2,
+        )
+
+    def to_prometheus(self):
+        name = "text_extraction_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each stage of update.",
+            f"# TYPE {name} histogram",
+        ]
+        for (stage, jurisdiction, media_type), h in sorted(self.histograms.items()):
+            labels = f'stage="{stage}",jurisdiction="{jurisdiction}",media_type="{media_type}"'
+            lines.extend(_histogram_lines(name, labels, h))
+        name = "text_extraction_sanitizer_seconds"
+        lines.append(f"# HELP {name} Time spent in each sanitizer pass.")
+        lines.append(f"# TYPE {name} histogram")
+        for (sanitizer, jurisdiction), h in sorted(self.sanitizers.items()):
+            labels = f'sanitizer="{sanitizer}",jurisdiction="{jurisdiction}"'
+            lines.extend(_histogram_lines(name, labels, h))
+        name = "text_extraction_errors_total"
+        lines.append(f"# HELP {name} Bills saved as errors, by reason.")
+        lines.append(f"# TYPE {name} counter")
+        for (reason, jurisdiction), count in sorted(self.errors.items()):
+            lines.append(f'{name}{{reason="{reason}",jurisdiction="{jurisdiction}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename, fmt="prometheus"):
+        text = self.to_json() if fmt == "json" else self.to_prometheus()
+        # write & rename so a scraper never reads a half-written file
+        with open(filename + ".tmp", "w") as f:
+            f.write(text)
+        os.replace(filename + ".tmp", filename)
+
+
+def _histogram_lines(name, labels, h):
+    cumulative = 0
+    for bound, n in zip(BUCKETS, h.counts):
+        cumulative += n
+        le = "+Inf" if bound == float("inf") else str(bound)
+        yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+    yield f"{name}_sum{{{labels}}} {h.sum}"
+    yield f"{name}_count{{{labels}}} {h.count}"
+
+
+@contextmanager
+def profiled(enabled):
+    """ yields a dict that gets the cProfile stats of the block (if enabled) & its duration """
+    result = {}
+    profiler = cProfile.Profile() if enabled else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield result
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.create_stats()
+            result["stats"] = profiler.stats
+        result["seconds"] = time.perf_counter() - start
+
+
+class SlowestProfiles:
+    """ keeps the cProfile stats of the N slowest documents """
+
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+
+    def add(self, seconds, label, stats):
+        entry = (seconds, label, stats)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, entry)
+        elif seconds > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def save(self, directory):
+        """ write each profile in the marshal format pstats/snakeviz read, slowest first """
+        os.makedirs(directory, exist_ok=True)
+        saved = []
+        for rank, (seconds, label, stats) in enumerate(sorted(self.heap, reverse=True), 1):
+            safe_label = "".join(c if c.isalnum() else "_" for c in label)
+            filename = os.path.join(directory, f"{rank:03}-{safe_label}.prof")
+            with open(filename, "wb") as f:
+                marshal.dump(stats, f)
+            saved.append((filename, seconds))
+        return saved
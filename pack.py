@@ -0,0 +1,102 @@
+import os
+import mmap
+import fcntl
+import threading
+from cache import SqliteIndex
+from extract.document import Document, as_document
+
+# where sample/test/benchmark keep packed documents when asked to, e.g. --pack raw/pack
+PACK_DIR = os.environ.get("TEXT_EXTRACT_PACK_DIR", "raw/pack")
+
+
+class SamplePack(SqliteIndex):
+    """
+    The sample documents packed into a handful of append-only shard files instead of a
+    file per version.
+
+    Bodies are stored once per sha256 digest, in the shard picked by the digest, and the
+    index maps each (state, version id, url) to its body. Reads are zero-copy slices of a
+    memory map of the shard.
+    """
+
+    SHARDS = 16
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS blobs "
+        "(digest TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, size INTEGER)",
+        "CREATE TABLE IF NOT EXISTS entries (state TEXT, version_id TEXT, url TEXT, "
+        "digest TEXT, PRIMARY KEY (state, version_id, url))",
+    )
+
+    def __init__(self, root=PACK_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._maps = {}
+        super().__init__(os.path.join(root, "index.sqlite"))
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, f"shard-{shard:02x}.pack")
+
+    def _map(self, shard, end):
+        """ a memory map of the shard covering at least up to `end` """
+        with self._lock:
+            mapped = self._maps.get(shard)
+            if mapped is None or len(mapped) < end:
+                # remapped once it has grown, slices of the old map keep it alive
+                with open(self.shard_path(shard), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[shard] = mapped
+            return mapped
+
+    def get(self, state, version_id, url):
+        """ the packed Document, or None """
+        row = self.db.execute(
+            "SELECT b.digest, b.shard, b.offset, b.size FROM entries e "
+            "JOIN blobs b ON b.digest = e.digest "
+            "WHERE e.state = ? AND e.version_id = ? AND e.url = ?",
+            (state, version_id, url),
+        ).fetchone()
+        if row is None:
+            return None
+        digest, shard, offset, size = row
+        if not size:
+            return Document(data=b"", digest=digest)
+        buffer = memoryview(self._map(shard, offset + size))[offset : offset + size]
+        return Document(data=buffer, digest=digest)
+
+    def add(self, state, version_id, url, data):
+        """ pack a Document (or bytes), only appending the body if it's new """
+        document = as_document(data)
+        digest = document.digest
+        # the lock keeps download threads from appending the same body twice
+        with self._lock:
+            self._append(document, digest)
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries (state, version_id, url, digest) VALUES (?, ?, ?, ?)",
+            (state, version_id, url, digest),
+        )
+        return digest
+
+    def _append(self, document, digest):
+        known = self.db.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if not known:
+            shard = int(digest[:2], 16) % self.SHARDS
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.shard_path(shard), "ab") as f:
+                # other processes may be appending to the same shard
+                fcntl.flock(f, fcntl.LOCK_EX)
+                offset = f.seek(0, os.SEEK_END)
+                for chunk in document.chunks():
+                    f.write(chunk)
+            self.db.execute(
+                "INSERT OR IGNORE INTO blobs (digest, shard, offset, size) VALUES (?, ?, ?, ?)",
+                (digest, shard, offset, len(document)),
+            )
+
+    def stats(self):
+        """ (entries, distinct bodies, bytes of bodies) """
+        (entries,) = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()
+        blobs, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()
+        return entries, blobs, size
@@ -1,52 +1,135 @@
-import re 
-from extract.utils import jid_to_abbr
+import re
+import time
+import functools
+from extract.utils import jid_to_abbr, code_fingerprint
 
 
 class Sanitizer:
-    """Abstract base class for sanitizing extracted text with pre-compiled regular expressions."""
+    """Abstract base class for sanitizing extracted text with pre-compiled regular expressions.
+        `trigger` is a substring every match contains, so the pass can be skipped when it's
+        absent, and `fusable` sanitizers may share a single regex pass with their neighbors.
+    """
+    trigger = None
+    replacement = ''
+    fusable = False
     def __init__(self):
         self.re = None
     def sanitize(self, text):
-        return self.re.sub('', text)
+        return self.re.sub(self.replacement, text)
 
 class LineNumCleaner(Sanitizer):
     """Removes line numbers from extracted text."""
+    trigger = 'line'
     def __init__(self):
-        self.re = re.compile(r"^ *line *\d+", flags=re.MULTILINE) 
+        self.re = re.compile(r"^ *line *\d+", flags=re.MULTILINE)
 
 class NewlineCleaner(Sanitizer):
     """Removes excessive newlines from extracted text."""
+    trigger = '\n\n'
+    fusable = True
     def __init__(self):
         self.re = re.compile(r"\n(?=\n)")
 
 class TexasCSSCleaner(Sanitizer):
     """Removes the line of CSS from extracted TX text."""
+    trigger = 'td { font-family: Courier, Arial, sans-serif; font-size: 10pt; }'
     def __init__(self):
         self.re = re.compile(r"td { font-family: Courier, Arial, sans-serif; font-size: 10pt; }.*")
 
 class FontDefCleaner(Sanitizer):
     """Removes HTML font definitions from extracted TX text."""
+    trigger = '--'
     def __init__(self):
         self.re = re.compile(r"<!?--.+>", flags=re.DOTALL)
 
 class NbspCleaner(Sanitizer):
     """Replaces NBSP with SP"""
+    trigger = '\xa0'
+    replacement = ' '
     def __init__(self):
         self.re = re.compile(r"\xa0")
     def sanitize(self, text):
-        return self.re.sub(' ', text)
+        # a plain character swap, no need for the regex engine
+        return text.replace('\xa0', ' ')
 
 class CarriageReturnCleaner(Sanitizer):
     """Removes carriage returns from extracted text."""
+    trigger = '\r\n'
+    fusable = True
     def __init__(self):
         self.re = re.compile(r"\r(?=\n)", flags=re.DOTALL)
 
 class SpaceCleaner(Sanitizer):
     """Collapses spaces in extracted text."""
+    trigger = '\t'
+    fusable = True
     def __init__(self):
         self.re = re.compile(r"\t(?<= )")
 
 
+class FusedSanitizer(Sanitizer):
+    """Runs several fusable sanitizers as one alternation, in a single pass over the text.
+        Only valid for sanitizers whose matches can't create or destroy each other's,
+        which is what `fusable` promises.
+    """
+    def __init__(self, sanitizers):
+        self.sanitizers = sanitizers
+        self.replacement = sanitizers[0].replacement
+        triggers = [s.trigger for s in sanitizers]
+        self.trigger = None if None in triggers else triggers
+        self.re = re.compile('|'.join(_scoped(s.re) for s in sanitizers))
+
+
+def _scoped(regex):
+    """Wraps a compiled pattern so its flags still apply once joined with others."""
+    flags = ''.join(letter for flag, letter in ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'),
+                                                (re.DOTALL, 's'), (re.VERBOSE, 'x'))
+                    if regex.flags & flag)
+    return f'(?{flags}:{regex.pattern})' if flags else f'(?:{regex.pattern})'
+
+
+class SanitizerPipeline:
+    """A compiled list of sanitizers: consecutive fusable sanitizers with the same replacement
+        share one pass, passes whose trigger is absent are skipped, and the time spent in
+        each pass can be reported to metrics. Output is the same as clean() on the list.
+    """
+    def __init__(self, sanitizers):
+        self.sanitizers = list(sanitizers)
+        self.passes = []
+        for sanitizer in self.sanitizers:
+            previous = self.passes[-1] if self.passes else None
+            if (sanitizer.fusable and previous and previous[-1].fusable
+                    and previous[-1].replacement == sanitizer.replacement):
+                previous.append(sanitizer)
+            else:
+                self.passes.append([sanitizer])
+        self.passes = [(' + '.join(type(s).__name__ for s in group),
+                        group[0] if len(group) == 1 else FusedSanitizer(group))
+                       for group in self.passes]
+        # the pipeline's own code too, the fusing & skipping is what produces the text
+        self.fingerprint = code_fingerprint(self)
+
+    def __iter__(self):
+        return iter(self.sanitizers)
+
+    def clean(self, text, timings=None):
+        """Runs each pass whose trigger is in the text, appending
+            ("sanitizer", pass name, seconds) to timings for each one run if it's given.
+        """
+        for name, sanitizer in self.passes:
+            trigger = sanitizer.trigger
+            if isinstance(trigger, str):
+                if trigger not in text:
+                    continue
+            elif trigger is not None and not any(t in text for t in trigger):
+                continue
+            start = time.perf_counter()
+            text = sanitizer.sanitize(text)
+            if timings is not None:
+                timings.append(("sanitizer", name, time.perf_counter() - start))
+        return text
+
+
 def get_sanitizers(state, is_jid=False):
     """Determines which sanitizers to use on text based on jurisdiction id.
         Returns: a list of instances of each appropriate sanitizer.
@@ -56,9 +139,11 @@ def get_sanitizers(state, is_jid=False):
         'tx' : [FontDefCleaner, TexasCSSCleaner]
     }
 
+    # NbspCleaner goes first so the remaining whitespace cleaners can be fused,
+    # none of them match NBSP or spaces so the order doesn't change the output
     sanitizers_all = [
-        NewlineCleaner,
         NbspCleaner,
+        NewlineCleaner,
         CarriageReturnCleaner,
         SpaceCleaner
     ]
@@ -71,10 +156,31 @@ def get_sanitizers(state, is_jid=False):
         sanitizers_spec = []
     return [s() for s in sanitizers_all + sanitizers_spec]
 
-def clean(sanitizers, text):
-    """Sanitizes text using each of the given sanitizers, input as a list 
-        of instantiated objects (like output of get_sanitizers()).
+def get_pipeline(state, is_jid=False):
+    """Like get_sanitizers(), but returns a SanitizerPipeline built once per state."""
+    if is_jid == True:
+        state = jid_to_abbr(state)
+    return _build_pipeline(state)
+
+@functools.lru_cache(maxsize=None)
+def _build_pipeline(state):
+    return SanitizerPipeline(get_sanitizers(state))
+
+def clean(sanitizers, text, timings=None):
+    """Sanitizes text using each of the given sanitizers, input as a list
+        of instantiated objects (like output of get_sanitizers()) or a SanitizerPipeline,
+        which also times each of its passes into timings if given.
     """
+    if isinstance(sanitizers, SanitizerPipeline):
+        return sanitizers.clean(text, timings)
     for sanitizer in sanitizers:
-        text = sanitizer.sanitize(text)  
-    return text  
\ No newline at end of file
+        text = sanitizer.sanitize(text)
+    return text
+
+def sanitizers_fingerprint(sanitizers):
+    """Identifies a list of sanitizers, including their patterns and code, so that
+        cached results are invalidated when a state's sanitizers change.
+    """
+    if isinstance(sanitizers, SanitizerPipeline):
+        return sanitizers.fingerprint
+    return code_fingerprint(list(sanitizers))
@@ -0,0 +1,126 @@
+import os
+import gzip
+import json
+import sqlite3
+
+# where sample writes a state's extracted text with --output-format shards
+SHARD_DIR = os.path.join("text", "shards")
+
+# records per gzip member, the unit a random read has to decompress
+MEMBER_RECORDS = 200
+# ...or fewer, once this much text is waiting
+MEMBER_BYTES = 4 * 1024 * 1024
+
+
+def shard_paths(state, root=SHARD_DIR):
+    """ (gzipped JSON lines, sqlite index) for a state """
+    return os.path.join(root, f"{state}.jsonl.gz"), os.path.join(root, f"{state}.index.sqlite")
+
+
+class TextShardWriter:
+    """
+    Writes one state's extracted text as gzipped JSON lines, one record per document.
+
+    Records are buffered and written as a gzip member at a time; a file of concatenated
+    members is still a valid gzip file, so bulk loading just streams it. The index maps
+    each (version id, url) to its member's offset & length and its line within the member.
+    Everything is written under temporary names and renamed into place on close(), or
+    removed by abort() so a failed run leaves the previous shard alone.
+    """
+
+    def __init__(self, state, root=SHARD_DIR):
+        self.path, self.index_path = shard_paths(state, root)
+        os.makedirs(root, exist_ok=True)
+        self._file = open(self.path + ".tmp", "wb")
+        if os.path.exists(self.index_path + ".tmp"):
+            os.remove(self.index_path + ".tmp")
+        self._index = sqlite3.connect(self.index_path + ".tmp")
+        self._index.execute(
+            "CREATE TABLE records (version_id TEXT, url TEXT, offset INTEGER, "
+            "length INTEGER, line INTEGER, PRIMARY KEY (version_id, url))"
+        )
+        self._pending = []
+        self._pending_bytes = 0
+
+    def add(self, version, extractor, raw_bytes, text):
+        """ queue a record, writing out a member once enough are waiting """
+        record = {
+            "version_id": version["id"],
+            "url": version["url"],
+            "extractor": extractor,
+            "raw_bytes": raw_bytes,
+            "text_bytes": len(text.encode("utf8")),
+            "text": text,
+        }
+        self._pending.append(record)
+        self._pending_bytes += record["text_bytes"]
+        if len(self._pending) >= MEMBER_RECORDS or self._pending_bytes >= MEMBER_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        lines = "".join(json.dumps(record) + "\n" for record in self._pending)
+        member = gzip.compress(lines.encode("utf8"))
+        offset = self._file.tell()
+        self._file.write(member)
+        self._index.executemany(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)",
+            [
+                (record["version_id"], record["url"], offset, len(member), line)
+                for line, record in enumerate(self._pending)
+            ],
+        )
+        self._index.commit()
+        self._pending = []
+        self._pending_bytes = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self._index.close()
+        os.replace(self.path + ".tmp", self.path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def abort(self):
+        self._file.close()
+        self._index.close()
+        os.remove(self.path + ".tmp")
+        os.remove(self.index_path + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TextShard:
+    """ reads a shard written by TextShardWriter """
+
+    def __init__(self, state, root=SHARD_DIR):
+        self.path, self.index_path = shard_paths(state, root)
+
+    def __iter__(self):
+        """ every record, in the order they were written """
+        with gzip.open(self.path, "rt", encoding="utf8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def get(self, version_id, url):
+        """ one record, decompressing only the member it's in, or None """
+        with sqlite3.connect(self.index_path) as index:
+            row = index.execute(
+                "SELECT offset, length, line FROM records WHERE version_id = ? AND url = ?",
+                (version_id, url),
+            ).fetchone()
+        if row is None:
+            return None
+        offset, length, line = row
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            member = gzip.decompress(f.read(length))
+        return json.loads(member.decode("utf8").splitlines()[line])
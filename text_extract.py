@@ -1,25 +1,107 @@
 #!/usr/bin/env python
+import io
 import os
 import sys
 import csv
+import json
 import math
+import time
+import hashlib
+import functools
+import itertools
+import contextlib
+import threading
 import warnings
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse
 import click
 import scrapelib
+from requests.adapters import HTTPAdapter
 from django.contrib.postgres.search import SearchVector
-from django.db import transaction
-from django.db.models import Count
+from django.db import connections, transaction
+from django.db.models import Count, Exists, F, OuterRef, Prefetch, Q, Subquery, TextField, Value
+from django.db.models.functions import Cast, Coalesce
 from openstates.utils.django import init_django
 from extract.utils import jid_to_abbr, abbr_to_jid
-from extract import get_extract_func, DoNotDownload, CONVERSION_FUNCTIONS
+from extract import (
+    get_extract_func,
+    extractor_fingerprint,
+    extractor_name,
+    DoNotDownload,
+    CONVERSION_FUNCTIONS,
+)
+from extract.document import Document, as_document
+from extract.pdf import PDF_BACKENDS, get_pdf_backend, set_pdf_backend, DEFAULT_PDF_BACKEND
 from sanitize import *
+from cache import (
+    CACHE_DIR,
+    DOWNLOAD_CHUNK_SIZE,
+    DocumentCache,
+    LinkStats,
+    ResultCache,
+    stream_to_file,
+    temporary_name,
+)
+from benchmark import Benchmark, load_baseline, save_baseline, regressions
+from metrics import Metrics, SlowestProfiles, timed, profiled
+from leases import WorkQueue
+from limits import Limits, LimitExceeded, run_limited, start_fork_server
+from pack import PACK_DIR, SamplePack
+from shards import SHARD_DIR, TextShardWriter
+
+# default size of the download pool & number of simultaneous requests per host
+DOWNLOAD_WORKERS = 16
+PER_HOST_CONCURRENCY = 4
+# bills loaded into memory at once by update
+BILL_BATCH_SIZE = 500
+# fingerprints of each state as of its last passing test, for test --changed
+TEST_FINGERPRINTS = os.path.join(CACHE_DIR, "test-fingerprints.json")
 
 # disable SSL validation and ignore warnings
+# update fetches bill text through scraper, throttled by scrapelib in each worker process
 scraper = scrapelib.Scraper(verify=False)
 scraper.user_agent = "Mozilla"
+# sample's download threads are rate-limited per host by HostLimiter instead
+sample_scraper = scrapelib.Scraper(verify=False, requests_per_minute=0)
+sample_scraper.user_agent = "Mozilla"
 warnings.filterwarnings("ignore", module="urllib3")
 
 
+# bill text fetched by update is kept on disk & revalidated with conditional GETs
+document_cache = DocumentCache()
+# sanitized text, reused while the document, extractor & sanitizers are unchanged
+result_cache = ResultCache()
+# how long each jurisdiction's media types take to extract & how often that works
+link_stats = LinkStats()
+
+
+def _configure_pool(size):
+    """ keep enough pooled connections around for `size` concurrent downloads """
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    sample_scraper.mount("http://", adapter)
+    sample_scraper.mount("https://", adapter)
+
+
+class HostLimiter:
+    """ caps the number of in-flight requests to any one legislature host """
+
+    def __init__(self, per_host=PER_HOST_CONCURRENCY):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+
+host_limiter = HostLimiter()
+
+
 MIMETYPES = {
     "application/pdf": "pdf",
     "text/html": "html",
@@ -34,36 +116,134 @@ def _cleanup(text):
     return text.replace("\0", "")
 
 
-def download(version):
+def raw_filename(version):
     abbr = jid_to_abbr(version["jurisdiction_id"])
     ext = MIMETYPES[version["media_type"]]
     filename = f'raw/{abbr}/{version["session"]}-{version["identifier"]}-{version["note"]}.{ext}'
     filename.replace("#", "__")
+    return filename
+
 
-    if not os.path.exists(filename):
+def text_filename_for(filename):
+    return filename.replace("raw/", "text/") + ".txt"
+
+
+def saved_document(version, pack=None):
+    """ the already downloaded Document for a sample version, from pack if given, or None """
+    if pack is not None:
+        abbr = jid_to_abbr(version["jurisdiction_id"])
+        return pack.get(abbr, version["id"], version["url"])
+    filename = raw_filename(version)
+    # extractors read the file (or a memory map of it) in place
+    return Document(path=filename) if os.path.exists(filename) else None
+
+
+def _fetch(url, path, limiter=None):
+    """ stream url to path, False if it couldn't be fetched """
+    limiter = limiter or host_limiter
+    try:
+        with limiter.slot(url):
+            with sample_scraper.get(url, stream=True) as resp:
+                stream_to_file(path, resp.iter_content(DOWNLOAD_CHUNK_SIZE))
+    except Exception:
+        return False
+    return True
+
+
+def download(version, limiter=None, pack=None):
+    """ (raw filename, Document) for a version, fetching it into raw/ or the pack if needed """
+    filename = raw_filename(version)
+    document = saved_document(version, pack)
+    if document is not None:
+        return filename, document
+
+    if pack is not None:
+        tmp_path = temporary_name(os.path.join(pack.root, "incoming"))
+        if not _fetch(version["url"], tmp_path, limiter):
+            return None, None
+        with Document(path=tmp_path) as fetched:
+            abbr = jid_to_abbr(version["jurisdiction_id"])
+            pack.add(abbr, version["id"], version["url"], fetched)
+        os.remove(tmp_path)
+    else:
         try:
             os.makedirs(os.path.dirname(filename))
         except OSError:
             pass
-        try:
-            _, resp = scraper.urlretrieve(version["url"], filename)
-        except Exception:
-            click.secho("could not fetch " + version["url"], fg="yellow")
+        tmp_path = temporary_name(filename)
+        if not _fetch(version["url"], tmp_path, limiter):
             return None, None
+        os.replace(tmp_path, filename)
+    return filename, saved_document(version, pack)
 
-        return filename, resp.content
-    else:
-        with open(filename, "rb") as f:
-            return filename, f.read()
+
+def download_all(versions, workers=DOWNLOAD_WORKERS, per_host=PER_HOST_CONCURRENCY, pack=None):
+    """
+    Download versions concurrently, yielding (version, filename, document) in input order
+    as soon as each result is available so extraction can overlap with the downloads.
+
+    Versions that map to the same raw filename are fetched once, from the first of them,
+    & every one of them gets that document, the same as when they were fetched in order.
+    """
+    limiter = HostLimiter(per_host)
+    _configure_pool(workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        downloads = {}
+        for version in versions:
+            filename = raw_filename(version)
+            if filename not in downloads:
+                downloads[filename] = (version, pool.submit(download, version, limiter, pack))
+        for version in versions:
+            first, future = downloads[raw_filename(version)]
+            filename, document = future.result()
+            if version is not first and filename:
+                document = saved_document(first, pack)
+            yield version, filename, document
+
+
+def _start_fork_server():
+    """ have run_limited fork from a helper process, call before starting any threads """
+    start_fork_server(func for funcs in CONVERSION_FUNCTIONS.values() for func in funcs.values())
+
+
+def extract_text(func, data, metadata, sanitizers, timings=None, limits=None):
+    """
+    func(data, metadata) run through the sanitizers, reusing any cached result,
+    time spent extracting & sanitizing is appended to timings if given,
+    and with limits func runs in a child process that's killed if it goes over them
+    """
+    timings = [] if timings is None else timings
+    with timed(timings, "extract", metadata["media_type"]):
+        key = result_cache.key(
+            as_document(data).digest,
+            extractor_fingerprint(func),
+            sanitizers_fingerprint(sanitizers),
+            metadata,
+        )
+        cached = result_cache.get(key)
+        if cached is None and limits:
+            text = run_limited(func, (data, metadata), limits)
+        elif cached is None:
+            text = func(data, metadata)
+    if cached is not None:
+        return cached
+    with timed(timings, "sanitize", metadata["media_type"]):
+        text = clean(sanitizers, text, timings)
+    result_cache.put(key, text)
+    return text
 
 
-def extract_to_file(filename, data, version, sanitizers=None):
+def extract_to_file(filename, data, version, sanitizers=None, limits=None, shard=None):
+    """
+    extract & save the text of a downloaded document, next to it in text/ or, given a
+    TextShardWriter, as a record in its state's shard
+    """
     try:
         func = get_extract_func(version)
         if func == DoNotDownload:
             return DoNotDownload, 0
         else:
-            text = clean(sanitizers, func(data, version))
+            text = extract_text(func, data, version, sanitizers, limits=limits)
     except Exception as e:
         click.secho(f"exception processing {version['url']}: {e}", fg="red")
         text = None
@@ -71,7 +251,11 @@ def extract_to_file(filename, data, version, sanitizers=None):
     if not text:
         return None, 0
 
-    text_filename = filename.replace("raw/", "text/") + ".txt"
+    if shard is not None:
+        shard.add(version, extractor_name(func), len(data), text)
+        return shard.path, len(text)
+
+    text_filename = text_filename_for(filename)
     try:
         os.makedirs(os.path.dirname(text_filename))
     except OSError:
@@ -82,63 +266,244 @@ def extract_to_file(filename, data, version, sanitizers=None):
     return text_filename, len(text)
 
 
-def update_bill(bill):
-    from openstates.data.models import SearchableBill
+# result of extracting a bill's text, returned from (possibly remote) extraction workers
+# timings are (stage, media_type, seconds) or ("sanitizer", pass name, seconds), profile the
+# cProfile stats when requested, error is why is_error is set: no_links, download, exception,
+# empty, or a LimitExceeded reason
+BillText = namedtuple(
+    "BillText",
+    ["bill_id", "link_id", "raw_text", "is_error", "timings", "profile", "error"],
+    defaults=((), None, None),
+)
+
 
+def bill_payload(bill):
+    """ the plain data extract_bill_text needs, small enough to send to a worker process """
+    # iter_bills prefetches just the latest version, a lone bill queries for them
+    versions = getattr(bill, "newest_versions", None)
+    if versions is None:
+        versions = bill.versions.order_by("-date", "-note").prefetch_related("links")
     try:
-        latest_version = bill.versions.order_by("-date", "-note").prefetch_related("links")[0]
-        links = latest_version.links.all()
+        latest_version = versions[0]
+        links = [(link.id, link.url, link.media_type) for link in latest_version.links.all()]
     except IndexError:
         links = []
+    return bill.id, bill.title, bill.legislative_session.jurisdiction_id, links
 
-    # Initialize sanitizers
-    sanitizers = get_sanitizers(bill.legislative_session.jurisdiction_id, is_jid=True)
 
-    # check if there's an old entry and we can use it
-    # if bill.searchable:
-    #     if bill.searchable.version_id == latest_version.id and not bill.searchable.is_error:
-    #         return      # nothing to do
-    #     bill.searchable.delete()
+def content_length(url):
+    """ size from a HEAD request, None when the server doesn't say or the request fails """
+    try:
+        resp = scraper.head(url, allow_redirects=True)
+        return int(resp.headers["Content-Length"])
+    except Exception:
+        return None
+
+
+def rank_links(candidates, state, head=False):
+    """
+    order (link_id, url, media_type, ...) tuples by expected seconds to get text from them,
+    cheapest first, using link_stats and, with head, the size of the document. Media types
+    without stats yet come first so they get measured, ties keep the database order.
+    """
+    if len(candidates) < 2:
+        return candidates
+    stats = link_stats.for_jurisdiction(state)
+
+    def cost(candidate):
+        media_type_stats = stats.get(candidate[2])
+        if not media_type_stats:
+            return 0.0
+        size = content_length(candidate[1]) if head else None
+        return LinkStats.expected_cost(media_type_stats, size)
+
+    return sorted(candidates, key=cost)
+
+
+def extract_bill_text(payload, profile=False, limits=None, head=False):
+    """ fetch, extract & sanitize the text for a bill, without touching the database """
+    bill_id, title, jurisdiction_id, links = payload
+    state = jid_to_abbr(jurisdiction_id)
+
+    # Initialize sanitizers
+    sanitizers = get_pipeline(jurisdiction_id, is_jid=True)
 
     # iterate through versions until we extract some good text
     is_error = True
+    error = "no_links"
     raw_text = ""
-    link = None
-    for link in links:
-        metadata = {
-            "url": link.url,
-            "media_type": link.media_type,
-            "title": bill.title,
-            "jurisdiction_id": bill.legislative_session.jurisdiction_id,
-        }
-        func = get_extract_func(metadata)
-        if func == DoNotDownload:
-            continue
-        try:
-            data = scraper.get(link.url).content
-        except Exception:
-            continue
-        try:
-            raw_text = func(data, metadata)
-        except Exception as e:
-            click.secho(f"exception processing {metadata['url']}: {e}", fg="red")
-
-        # clean up whitespace and run other sanitizers by state
-        raw_text = clean(sanitizers, raw_text)
-
-        if raw_text:
-            is_error = False
-            break
-
-    sb = SearchableBill.objects.create(
-        bill=bill,
-        version_link=link,
-        all_titles=bill.title,  # TODO: add other titles
-        raw_text=raw_text,
-        is_error=is_error,
-        search_vector="",
+    link_id = None
+    timings = []
+    with profiled(profile) as prof:
+        candidates = []
+        for link_id, url, media_type in links:
+            metadata = {
+                "url": url,
+                "media_type": media_type,
+                "title": title,
+                "jurisdiction_id": jurisdiction_id,
+            }
+            func = get_extract_func(metadata)
+            # skipped before ranking, so never even a HEAD request
+            if func != DoNotDownload:
+                candidates.append((link_id, url, media_type, metadata, func))
+
+        for link_id, url, media_type, metadata, func in rank_links(candidates, state, head):
+            start = time.perf_counter()
+            try:
+                with timed(timings, "download", media_type):
+                    document = document_cache.fetch(scraper, url)
+            except Exception:
+                error = "download"
+                link_stats.record(state, media_type, time.perf_counter() - start, 0, False)
+                continue
+            document_limits = None
+            if limits and not profile:
+                # a profile needs the extractor to run in this process
+                document_limits = limits.for_document(state, media_type)
+            try:
+                # clean up whitespace and run other sanitizers by state
+                raw_text = extract_text(
+                    func, document, metadata, sanitizers, timings, document_limits
+                )
+                error = "empty"
+            except LimitExceeded as e:
+                click.secho(f"{e.reason} limit processing {metadata['url']}: {e}", fg="red")
+                error = e.reason
+            except Exception as e:
+                click.secho(f"exception processing {metadata['url']}: {e}", fg="red")
+                error = "exception"
+            finally:
+                n_bytes = len(document)
+                document.close()
+            link_stats.record(
+                state, media_type, time.perf_counter() - start, n_bytes, bool(raw_text)
+            )
+
+            if raw_text:
+                is_error = False
+                error = None
+                break
+
+    return BillText(
+        bill_id, link_id, raw_text, is_error, timings, prof if profile else None, error
+    )
+
+
+class SearchableBillWriter:
+    """
+    Buffers SearchableBill rows and writes them with one bulk query per flush,
+    flush() returns the ids of everything written so they can go straight to reindex
+    """
+
+    FIELDS = ["version_link_id", "all_titles", "raw_text", "is_error", "search_vector"]
+
+    def __init__(self, replace=False):
+        self.replace = replace
+        self.pending = []
+
+    def add(self, result, title):
+        from openstates.data.models import SearchableBill
+
+        self.pending.append(
+            SearchableBill(
+                bill_id=result.bill_id,
+                version_link_id=result.link_id,
+                all_titles=title,  # TODO: add other titles
+                raw_text=result.raw_text,
+                is_error=result.is_error,
+                search_vector="",
+            )
+        )
+
+    def flush(self):
+        from openstates.data.models import SearchableBill
+
+        pending, self.pending = self.pending, []
+        if self.replace:
+            # reuse the ids of existing rows so they're updated in place
+            existing = dict(
+                SearchableBill.objects.filter(
+                    bill_id__in=[sb.bill_id for sb in pending]
+                ).values_list("bill_id", "id")
+            )
+            for sb in pending:
+                sb.id = existing.get(sb.bill_id)
+            SearchableBill.objects.bulk_update([sb for sb in pending if sb.id], self.FIELDS)
+            pending_create = [sb for sb in pending if not sb.id]
+        else:
+            pending_create = pending
+        # postgres returns the new primary keys from bulk_create
+        SearchableBill.objects.bulk_create(pending_create)
+        return [sb.id for sb in pending]
+
+
+def iter_bills(bills, batch_size=BILL_BATCH_SIZE):
+    """
+    stream bills in id order, a batch at a time, with their session, latest version & its
+    links prefetched so each batch costs a fixed number of queries however many bills there are
+    """
+    from openstates.data.models import BillVersion
+
+    latest_version = (
+        BillVersion.objects.filter(bill=OuterRef("bill")).order_by("-date", "-note").values("id")
+    )
+    # only the version bill_payload reads, not every version of every bill
+    versions = BillVersion.objects.filter(id=Subquery(latest_version[:1]))
+    versions = versions.prefetch_related("links")
+    bills = (
+        bills.select_related("legislative_session")
+        .prefetch_related(Prefetch("versions", queryset=versions, to_attr="newest_versions"))
+        .order_by("id")
+    )
+    after = None
+    while True:
+        page = bills if after is None else bills.filter(id__gt=after)
+        batch = list(page[:batch_size])
+        if not batch:
+            return
+        yield from batch
+        after = batch[-1].id
+
+
+def leased_bills(queue, bills, lease_size):
+    """ lease bills from the work queue & stream the ones still in `bills` until it's empty """
+    from openstates.data.models import SearchableBill
+
+    while True:
+        claimed = queue.claim(lease_size)
+        if not claimed:
+            return
+        todo = set(bills.filter(id__in=claimed).values_list("id", flat=True))
+        others = [bill_id for bill_id in claimed if bill_id not in todo]
+        # a queued bill may have been finished since, e.g. by a worker whose lease expired,
+        # anything else isn't this worker's to drop, e.g. queued by an --incremental run
+        done = set(
+            SearchableBill.objects.filter(bill_id__in=others).values_list("bill_id", flat=True)
+        )
+        queue.complete(done, commit=True)
+        queue.release([bill_id for bill_id in others if bill_id not in done])
+        yield from iter_bills(bills.filter(id__in=todo))
+
+
+def changed_bills(bills):
+    """
+    bills with saved text that didn't come from one of their latest version's links, as long
+    as that version has links, otherwise its error row would be rewritten on every run
+    """
+    from openstates.data.models import BillVersion, BillVersionLink
+
+    latest_version = (
+        BillVersion.objects.filter(bill=OuterRef("pk")).order_by("-date", "-note").values("id")
+    )
+    latest_links = BillVersionLink.objects.filter(version_id=OuterRef("latest_version_id"))
+    return (
+        bills.filter(searchable__isnull=False)
+        .annotate(latest_version_id=Subquery(latest_version[:1]))
+        .annotate(latest_has_links=Exists(latest_links))
+        .filter(latest_has_links=True)
+        .exclude(searchable__version_link__version_id=F("latest_version_id"))
     )
-    return sb.id
 
 
 @click.group()
@@ -194,22 +559,49 @@ def _resample(state, n=50):
 @click.argument("state")
 @click.option("--resample/--no-resample", default=False)
 @click.option("--quiet/--no-quiet", default=False)
-def sample(state, resample, quiet):
+@click.option("--workers", default=DOWNLOAD_WORKERS, help="number of concurrent downloads")
+@click.option("--per-host", default=PER_HOST_CONCURRENCY, help="concurrent requests per host")
+@click.option("--limits", "limits_file", help="JSON overriding the per-document limits")
+@click.option("--pack/--no-pack", default=False, help=f"keep documents in {PACK_DIR}, not raw/")
+@click.option(
+    "--output-format",
+    type=click.Choice(["files", "shards"]),
+    default="files",
+    help=f"a text file per document, or a compressed shard per state in {SHARD_DIR}",
+)
+def sample(state, resample, quiet, workers, per_host, limits_file, pack, output_format):
     if resample:
         _resample(state)
     count = missing = empty = skipped = 0
 
     # Initialize sanitizers
-    sanitizers = get_sanitizers(state)
+    sanitizers = get_pipeline(state)
+    limits = Limits.from_file(limits_file) if limits_file else Limits()
+    pack = SamplePack() if pack else None
+    # before download_all starts its threads
+    _start_fork_server()
 
     with open(f"raw/{state}.csv") as f:
-        for version in csv.DictReader(f):
+        versions = list(csv.DictReader(f))
+
+    # a run that fails part way leaves any previous shard in place
+    shards = output_format == "shards"
+    with TextShardWriter(state) if shards else contextlib.nullcontext() as shard:
+        for version, filename, document in download_all(versions, workers, per_host, pack):
             count += 1
-            filename, data = download(version)
             if not filename:
+                click.secho("could not fetch " + version["url"], fg="yellow")
                 missing += 1
                 continue
-            text_filename, n_bytes = extract_to_file(filename, data, version, sanitizers)
+            with document:
+                text_filename, n_bytes = extract_to_file(
+                    filename,
+                    document,
+                    version,
+                    sanitizers,
+                    limits.for_document(state, version["media_type"]),
+                    shard,
+                )
             if text_filename == DoNotDownload:
                 skipped += 1
             elif not n_bytes:
@@ -229,30 +621,298 @@ def sample(state, resample, quiet):
     return 0
 
 
+def state_fingerprint(state):
+    """ changes whenever a state's extractors, sanitizers or sample csv do """
+    parts = [
+        f"{media_type}={extractor_fingerprint(func)}"
+        for media_type, func in sorted(CONVERSION_FUNCTIONS[state].items())
+    ]
+    parts.append(sanitizers_fingerprint(get_pipeline(state)))
+    with open(f"raw/{state}.csv", "rb") as f:
+        parts.append(hashlib.sha256(f.read()).hexdigest())
+    return hashlib.sha256("\n".join(parts).encode("utf8")).hexdigest()
+
+
+def _sample_quietly(state, pack, output_format):
+    """ sample a state with its output captured, so parallel states don't interleave """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        # color=True keeps click's styling, the parent strips it if it's not on a terminal
+        with click.Context(sample, color=True) as ctx:
+            failures = ctx.invoke(
+                sample, state=state, quiet=True, pack=pack, output_format=output_format
+            )
+    return failures, output.getvalue()
+
+
 @cli.command(help="run sample on all states, used for CI")
-@click.pass_context
-def test(ctx):
+@click.option("--pack/--no-pack", default=False, help=f"keep documents in {PACK_DIR}, not raw/")
+@click.option("--jobs", default=os.cpu_count() or 1, help="number of states tested at once")
+@click.option(
+    "--changed/--all",
+    default=False,
+    help="only test states whose extractors, sanitizers or sample changed since they passed",
+)
+@click.option(
+    "--fingerprints",
+    default=TEST_FINGERPRINTS,
+    help="where --changed keeps the fingerprints of passing states",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["files", "shards"]),
+    default="files",
+    help=f"a text file per document, or a compressed shard per state in {SHARD_DIR}",
+)
+def test(pack, jobs, changed, fingerprints, output_format):
     failures = 0
     states = sorted(CONVERSION_FUNCTIONS.keys())
+    current = {state: state_fingerprint(state) for state in states}
+    passed = {}
+    if os.path.exists(fingerprints):
+        with open(fingerprints) as f:
+            passed = json.load(f)
+    if changed:
+        states = [state for state in states if passed.get(state) != current[state]]
+
     click.secho(f"testing {len(states)} states...", fg="white")
-    for state in states:
-        failures += ctx.invoke(sample, state=state, quiet=True)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(
+            _sample_quietly, states, itertools.repeat(pack), itertools.repeat(output_format)
+        )
+        # in state order, each as soon as it and the states before it are done
+        for state, (state_failures, output) in zip(states, results):
+            click.echo(output, nl=False)
+            failures += state_failures
+            if not state_failures:
+                passed[state] = current[state]
+
+    os.makedirs(os.path.dirname(fingerprints) or ".", exist_ok=True)
+    with open(fingerprints + ".tmp", "w") as f:
+        json.dump(passed, f, indent=2, sort_keys=True)
+    os.replace(fingerprints + ".tmp", fingerprints)
     sys.exit(failures)
 
 
-@cli.command(help="print a status table showing the current condition of states")
-def status():
-    init_django()
+@cli.command(help="check each pdf backend reproduces the saved sample text for a state")
+@click.argument("state")
+@click.option("--pack/--no-pack", default=False, help=f"read documents from {PACK_DIR}")
+def compare_pdf_backends(state, pack):
+    sanitizers = get_pipeline(state)
+    pack = SamplePack() if pack else None
+    with open(f"raw/{state}.csv") as f:
+        versions = [v for v in csv.DictReader(f) if v["media_type"] == "application/pdf"]
+
+    failures = 0
+    for name in PDF_BACKENDS:
+        try:
+            get_pdf_backend(name)
+        except EnvironmentError as e:
+            click.secho(f"{name}: unavailable, {e}", fg="yellow")
+            continue
+        set_pdf_backend(name)
+        checked = mismatched = 0
+        for version in versions:
+            func = get_extract_func(version)
+            filename = raw_filename(version)
+            text_filename = text_filename_for(filename)
+            if func == DoNotDownload or not os.path.exists(text_filename):
+                continue
+            document = saved_document(version, pack)
+            if document is None:
+                continue
+            # newline="" so stray carriage returns are compared as written
+            with open(text_filename, newline="") as f:
+                expected = f.read()
+            checked += 1
+            # bypasses result_cache, which is shared between backends
+            with document:
+                text = clean(sanitizers, func(document, version))
+            if text != expected:
+                mismatched += 1
+                click.secho(f"{name}: {filename} does not match {text_filename}", fg="red")
+        click.secho(
+            f"{name}: {checked} checked, {mismatched} mismatched",
+            fg="red" if mismatched else "green",
+        )
+        failures += mismatched
+    set_pdf_backend(DEFAULT_PDF_BACKEND)
+    sys.exit(1 if failures else 0)
+
+
+@cli.command(help="time extraction of the already downloaded samples, without network access")
+@click.argument("states", nargs=-1)
+@click.option("--repeat", default=1, help="number of times to extract each document")
+@click.option("--output", help="write the results to this JSON file, e.g. as a new baseline")
+@click.option("--baseline", help="JSON results to compare against")
+@click.option("--threshold", default=0.2, help="slowdown vs. the baseline that counts as failure")
+@click.option("--pack/--no-pack", default=False, help=f"read documents from {PACK_DIR}")
+def benchmark(states, repeat, output, baseline, threshold, pack):
+    bench = Benchmark()
+    pack = SamplePack() if pack else None
+    for state in states or sorted(CONVERSION_FUNCTIONS.keys()):
+        sanitizers = get_pipeline(state)
+        with open(f"raw/{state}.csv") as f:
+            versions = list(csv.DictReader(f))
+        for version in versions:
+            func = get_extract_func(version)
+            # only documents sample has already downloaded, never the network
+            document = None if func == DoNotDownload else saved_document(version, pack)
+            if document is None:
+                continue
+            n_bytes = len(document)
+            for _ in range(repeat):
+                ok = True
+                start = time.perf_counter()
+                # straight through func & clean, result_cache would hide the real cost
+                try:
+                    with document:
+                        clean(sanitizers, func(document, version))
+                except Exception:
+                    ok = False
+                bench.add(state, extractor_name(func), n_bytes, time.perf_counter() - start, ok)
+
+    results = bench.results()
+    click.secho(
+        f"{'':32} | docs | errs |  docs/s |   MB/s |  p50 ms |  p95 ms |  p99 ms", fg="white"
+    )
+    for section in ("states", "extractors"):
+        for name, r in results[section].items():
+            click.echo(
+                f"{name:32} | {r['docs']:4} | {r['errors']:4} | {r['docs_per_s']:7.1f} | "
+                f"{r['mb_per_s']:6.2f} | {r['p50_ms']:7.1f} | {r['p95_ms']:7.1f} | "
+                f"{r['p99_ms']:7.1f}"
+            )
+    rss = results["peak_rss_mb"]
+    click.echo(f"peak RSS: {rss['self']:.0f}MB, children {rss['children']:.0f}MB")
+
+    if output:
+        save_baseline(results, output)
+    if baseline:
+        found = regressions(results, load_baseline(baseline), threshold)
+        for regression in found:
+            click.secho(f"regression: {regression}", fg="red")
+        sys.exit(1 if found else 0)
+
+
+def status_counts(states):
+    """ bills, bills missing text & bills with errors per state, in one grouped query """
     from openstates.data.models import Bill
 
+    jids = {abbr_to_jid(state): state for state in states}
+    counts = {state: {"bills": 0, "missing": 0, "errors": 0} for state in states}
+    rows = (
+        Bill.objects.filter(legislative_session__jurisdiction_id__in=list(jids))
+        .values("legislative_session__jurisdiction_id")
+        .annotate(
+            bills=Count("id"),
+            missing=Count("id", filter=Q(searchable__isnull=True)),
+            errors=Count("id", filter=Q(searchable__is_error=True)),
+        )
+        # clear any default ordering, it would end up in the GROUP BY
+        .order_by()
+    )
+    for row in rows:
+        state = jids[row.pop("legislative_session__jurisdiction_id")]
+        counts[state] = row
+    return counts
+
+
+def load_snapshot(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_snapshot(filename, counts):
+    with open(filename + ".tmp", "w") as f:
+        json.dump({"timestamp": time.time(), "states": counts}, f, indent=2, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+
+def _delta(label, now, before):
+    if before is None or now == before:
+        return ""
+    return f" {now - before:+}{label}"
+
+
+def _sample_versions(states):
+    for state in states or sorted(CONVERSION_FUNCTIONS.keys()):
+        with open(f"raw/{state}.csv") as f:
+            yield from csv.DictReader(f)
+
+
+@cli.command(help=f"copy downloaded sample documents from raw/ into {PACK_DIR}")
+@click.argument("states", nargs=-1)
+def pack_import(states):
+    pack = SamplePack()
+    for version in _sample_versions(states):
+        document = saved_document(version)
+        if document is not None:
+            with document:
+                abbr = jid_to_abbr(version["jurisdiction_id"])
+                pack.add(abbr, version["id"], version["url"], document)
+    entries, blobs, size = pack.stats()
+    click.secho(f"{entries} documents packed as {blobs} bodies, {size / 1024 / 1024:.1f}MB")
+
+
+@cli.command(help=f"write the sample documents in {PACK_DIR} back out to raw/")
+@click.argument("states", nargs=-1)
+def pack_export(states):
+    pack = SamplePack()
+    count = 0
+    for version in _sample_versions(states):
+        document = saved_document(version, pack)
+        if document is None:
+            continue
+        filename = raw_filename(version)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with document:
+            stream_to_file(temporary_name(filename), document.chunks())
+        os.replace(temporary_name(filename), filename)
+        count += 1
+    click.secho(f"wrote {count} documents to raw/")
+
+
+@cli.command(help="print a status table showing the current condition of states")
+@click.option("--snapshot", "snapshot_file", help="save counts here & show changes since last run")
+@click.option(
+    "--max-age",
+    default=0,
+    help="reuse a snapshot younger than this many seconds instead of querying",
+)
+def status(snapshot_file, max_age):
     states = sorted(CONVERSION_FUNCTIONS.keys())
+    previous = load_snapshot(snapshot_file) if snapshot_file else None
+
+    if previous and time.time() - previous["timestamp"] < max_age:
+        counts = previous["states"]
+        age = time.time() - previous["timestamp"]
+        click.secho(f"snapshot from {age:.0f}s ago", fg="white")
+        previous = None
+    else:
+        init_django()
+        counts = status_counts(states)
+        if snapshot_file:
+            save_snapshot(snapshot_file, counts)
+
+    if previous:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(previous["timestamp"]))
+        click.secho(f"changes since {when}", fg="white")
     click.secho("state |  bills  | missing | errors ", fg="white")
     click.secho("===================================", fg="white")
     for state in states:
-        all_bills = Bill.objects.filter(legislative_session__jurisdiction_id=abbr_to_jid(state))
-        missing_search = all_bills.filter(searchable__isnull=True).count()
-        errors = all_bills.filter(searchable__is_error=True).count()
-        all_bills = all_bills.count()
+        all_bills = counts[state]["bills"]
+        missing_search = counts[state]["missing"]
+        errors = counts[state]["errors"]
+        before = previous["states"].get(state, {}) if previous else {}
+        changes = (
+            _delta(" bills", all_bills, before.get("bills"))
+            + _delta(" missing", missing_search, before.get("missing"))
+            + _delta(" errors", errors, before.get("errors"))
+        )
 
         errcolor = mscolor = "green"
         if missing_search > 0:
@@ -271,22 +931,80 @@ def status():
             + click.style(f"{missing_search:6}%", fg=mscolor)
             + " | "
             + click.style(f"{errors:6}%", fg=errcolor)
+            + changes
         )
 
 
+def _id_chunks(queryset, chunk_size, after=None):
+    """ walk queryset in id order, yielding (first, last) ids of each chunk_size rows """
+    while True:
+        page = queryset.order_by("id")
+        if after is not None:
+            page = page.filter(id__gt=after)
+        ids = list(page.values_list("id", flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        after = ids[-1]
+
+
+def _reindex_chunk(queryset, first, last, stale_only):
+    """ recompute one chunk's vectors, committed on its own (autocommit) connection """
+    try:
+        chunk = queryset.filter(id__gte=first, id__lte=last)
+        if stale_only:
+            # tsvector = is a full text match in the ORM, so compare the vectors as text
+            chunk = chunk.annotate(
+                current_vector=Coalesce(Cast("search_vector", TextField()), Value("")),
+                fresh_vector=Cast(search_vector(), TextField()),
+            ).exclude(current_vector=F("fresh_vector"))
+        return last, chunk.update(search_vector=search_vector())
+    finally:
+        # runs in a worker thread, which otherwise keeps its connection open
+        connections.close_all()
+
+
 @cli.command(help="rebuild the search index objects for a given state")
 @click.argument("state")
-def reindex_state(state):
+@click.option("--chunk-size", default=1000, help="rows updated & committed per statement")
+@click.option("--jobs", default=1, help="number of chunks to update at once")
+@click.option("--resume/--no-resume", default=True, help="continue after an interrupted reindex")
+@click.option(
+    "--stale-only/--no-stale-only",
+    default=False,
+    help="only write vectors that differ from their raw_text & all_titles",
+)
+def reindex_state(state, chunk_size, jobs, resume, stale_only):
     init_django()
     from openstates.data.models import SearchableBill
 
-    ids = list(
-        SearchableBill.objects.filter(
-            bill__legislative_session__jurisdiction_id=abbr_to_jid(state)
-        ).values_list("id", flat=True)
+    searchable = SearchableBill.objects.filter(
+        bill__legislative_session__jurisdiction_id=abbr_to_jid(state)
     )
-    print(f"reindexing {len(ids)} bills for state")
-    reindex(ids)
+    cursor_filename = os.path.join(CACHE_DIR, f"reindex-{state}.cursor")
+    after = None
+    if resume and os.path.exists(cursor_filename):
+        with open(cursor_filename) as f:
+            after = json.load(f)
+        print(f"resuming after id {after}")
+    print(f"reindexing {searchable.count()} bills for state")
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    updated = 0
+    chunks = _id_chunks(searchable, chunk_size, after)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(
+            lambda chunk: _reindex_chunk(searchable, chunk[0], chunk[1], stale_only), chunks
+        )
+        # results arrive in id order, so the cursor only passes fully committed chunks
+        for last, count in results:
+            updated += count
+            with open(cursor_filename, "w") as f:
+                json.dump(last, f)
+    # finished, the next run starts from the beginning
+    if os.path.exists(cursor_filename):
+        os.remove(cursor_filename)
+    print(f"updated {updated}")
 
 
 @cli.command(help="update the saved bill text in the database")
@@ -294,7 +1012,44 @@ def reindex_state(state):
 @click.option("-n", default=None)
 @click.option("--clear-errors/--no-clear-errors", default=False)
 @click.option("--checkpoint", default=500)
-def update(state, n, clear_errors, checkpoint):
+@click.option("--workers", default=1, help="number of extraction processes")
+@click.option(
+    "--incremental/--no-incremental",
+    default=False,
+    help="also re-extract bills whose latest version has changed",
+)
+@click.option("--metrics", "metrics_file", help="write stage timings here at each checkpoint")
+@click.option("--metrics-format", type=click.Choice(["prometheus", "json"]), default="prometheus")
+@click.option("--profile", default=0, help="save cProfile output for the N slowest bills")
+@click.option(
+    "--distributed/--no-distributed",
+    default=False,
+    help="share the work with other update processes through leases in the database",
+)
+@click.option("--lease-size", default=100, help="bills leased at a time with --distributed")
+@click.option("--lease-seconds", default=600, help="lease lifetime without a heartbeat")
+@click.option("--limits", "limits_file", help="JSON overriding the per-document limits")
+@click.option(
+    "--head/--no-head",
+    default=False,
+    help="refine the choice of link with the Content-Length of a HEAD request",
+)
+def update(
+    state,
+    n,
+    clear_errors,
+    checkpoint,
+    workers,
+    incremental,
+    metrics_file,
+    metrics_format,
+    profile,
+    distributed,
+    lease_size,
+    lease_seconds,
+    limits_file,
+    head,
+):
     init_django()
     from openstates.data.models import Bill, SearchableBill
 
@@ -311,11 +1066,26 @@ def update(state, n, clear_errors, checkpoint):
             print("--clear-errors only works with specific states, not all")
             return
         errs = SearchableBill.objects.filter(bill__in=all_bills, is_error=True)
-        print(f"clearing {len(errs)} errors")
+        print(f"clearing {errs.count()} errors")
         errs.delete()
 
     missing_search = all_bills.filter(searchable__isnull=True)
-    if state == "all":
+    if incremental:
+        changed = changed_bills(all_bills)
+        print(f"{changed.count()} bills have a newer version")
+        missing_search = all_bills.filter(
+            Q(searchable__isnull=True) | Q(id__in=changed.values("id"))
+        )
+    queue = None
+    if distributed:
+        # no per-state limit, any number of processes can share a big backlog
+        jurisdiction_id = None if state == "all" else abbr_to_jid(state)
+        queue = WorkQueue(lease_seconds=lease_seconds, jurisdiction_id=jurisdiction_id)
+        queue.create()
+        print(f"queued {queue.enqueue(missing_search)} new bills")
+        total = queue.remaining()
+        print(f"{total} bills queued for all workers")
+    elif state == "all":
         MAX_UPDATE = 1000
         aggregates = missing_search.values("legislative_session__jurisdiction__name").annotate(
             count=Count("id")
@@ -330,49 +1100,129 @@ def update(state, n, clear_errors, checkpoint):
                 missing_search = missing_search.exclude(
                     legislative_session__jurisdiction__name=state_name
                 )
-        print(f"{len(missing_search)} missing, updating")
+        total = missing_search.count()
+        print(f"{total} missing, updating")
     else:
-        print(f"{state}: {len(all_bills)} bills, {len(missing_search)} without search results")
+        total = missing_search.count()
+        print(f"{state}: {all_bills.count()} bills, {total} without search results")
 
+    if queue:
+        bills = leased_bills(queue, missing_search, lease_size)
+    else:
+        bills = iter_bills(missing_search)
     if n:
-        missing_search = missing_search[: int(n)]
+        n = min(int(n), total)
+        bills = itertools.islice(bills, n)
     else:
-        n = len(missing_search)
+        n = total
 
-    ids_to_update = []
     updated_count = 0
+    payloads = (bill_payload(b) for b in bills)
+    writer = SearchableBillWriter(replace=incremental)
+    metrics = Metrics()
+    slowest = SlowestProfiles(profile)
+
+    # extraction can happen in worker processes, all database writes stay in this one
+    limits = Limits.from_file(limits_file) if limits_file else Limits()
+    extract = functools.partial(extract_bill_text, profile=bool(profile), limits=limits, head=head)
+    pool = None
+    if workers == 1:
+        # extraction happens in this process, start it before the heartbeat thread
+        _start_fork_server()
+    else:
+        # forked workers must not share the parent's database connection
+        connections.close_all()
+        pool = ProcessPoolExecutor(max_workers=workers)
+        # start the workers now, before iter_bills opens a connection they'd inherit
+        for future in [pool.submit(int) for _ in range(workers)]:
+            future.result()
+    results = _extract_in_order(extract, payloads, pool, window=workers * 4)
 
     # going to manage our own transactions here so we can save in chunks
     transaction.set_autocommit(False)
 
-    for b in missing_search:
-        ids_to_update.append(update_bill(b))
-        updated_count += 1
-        if updated_count % status_num == 0:
-            print(f"{state}: updated {updated_count} out of {n}")
-        if updated_count % checkpoint == 0:
-            reindex(ids_to_update)
-            transaction.commit()
-            ids_to_update = []
+    finished = []
+    with queue.heartbeat() if queue else contextlib.nullcontext():
+        for payload, result in results:
+            jurisdiction = jid_to_abbr(payload[2])
+            metrics.merge(result.timings, jurisdiction)
+            if result.error:
+                metrics.count_error(result.error, jurisdiction)
+            if result.profile:
+                slowest.add(result.profile["seconds"], result.bill_id, result.profile["stats"])
+            writer.add(result, payload[1])
+            finished.append(result.bill_id)
+            updated_count += 1
+            if updated_count % status_num == 0:
+                print(f"{state}: updated {updated_count} out of {n}")
+            if updated_count % checkpoint == 0:
+                # a crash before this commit loses at most this checkpoint's rows
+                with metrics.timer("db_write", state):
+                    ids_to_update = writer.flush()
+                    if queue:
+                        queue.complete(finished)
+                    finished = []
+                with metrics.timer("reindex", state):
+                    reindex(ids_to_update)
+                transaction.commit()
+                if metrics_file:
+                    metrics.dump(metrics_file, metrics_format)
 
-    # be sure to reindex final set
-    reindex(ids_to_update)
-    transaction.commit()
+        # be sure to write & reindex final set
+        with metrics.timer("db_write", state):
+            ids_to_update = writer.flush()
+            if queue:
+                queue.complete(finished)
+        with metrics.timer("reindex", state):
+            reindex(ids_to_update)
+        transaction.commit()
     transaction.set_autocommit(True)
+    if queue:
+        # e.g. leased beyond -n, let the other workers have them
+        queue.release()
+    if pool:
+        pool.shutdown()
+
+    if metrics_file:
+        metrics.dump(metrics_file, metrics_format)
+    if profile:
+        for filename, seconds in slowest.save("profiles"):
+            print(f"{seconds:.1f}s: {filename}")
+
+
+def _extract_in_order(extract, payloads, pool=None, window=1):
+    """
+    yield (payload, result) in order, with at most `window` payloads handed to the pool at
+    once so payloads are only loaded from the database as fast as they're extracted
+    """
+    if pool is None:
+        for payload in payloads:
+            yield payload, extract(payload)
+        return
+    pending = deque()
+    for payload in payloads:
+        pending.append((payload, pool.submit(extract, payload)))
+        if len(pending) >= window:
+            payload, future = pending.popleft()
+            yield payload, future.result()
+    while pending:
+        payload, future = pending.popleft()
+        yield payload, future.result()
 
 
 def reindex(ids_to_update):
     from openstates.data.models import SearchableBill
 
     print(f"updating {len(ids_to_update)} search vectors")
-    res = SearchableBill.objects.filter(id__in=ids_to_update).update(
-        search_vector=(
-            SearchVector("all_titles", weight="A", config="english")
-            + SearchVector("raw_text", weight="B", config="english")
-        )
-    )
+    res = SearchableBill.objects.filter(id__in=ids_to_update).update(search_vector=search_vector())
     print(f"updated {res}")
 
 
+def search_vector():
+    return SearchVector("all_titles", weight="A", config="english") + SearchVector(
+        "raw_text", weight="B", config="english"
+    )
+
+
 if __name__ == "__main__":
     cli()